@@ -0,0 +1,336 @@
+"""Micro benchmarks for ultracache internals. Run from the repository root, eg.
+
+    python bin/benchmark.py registry
+"""
+
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ultracache.tests.settings.22")
+
+import django
+django.setup()
+
+
+def report(name, seconds, number):
+    print("%-50s %10.2f us" % (name, seconds * 1000000.0 / number))
+
+
+_database = False
+
+
+def setup_database():
+    """Create an in-memory database with a site for the test server."""
+    global _database
+    if _database:
+        return
+    from django.conf import settings
+    from django.db import connection
+
+    connection.creation.create_test_db(verbosity=0)
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        from django.contrib.sites.models import Site
+        Site.objects.create(domain="testserver", name="testserver")
+    _database = True
+
+
+def legacy_reduce_list_size(li, max_size):
+    # The repr based trimming used before RegistryList
+    size = len(repr(li))
+    keep = li
+    toss = []
+    n = len(li)
+    decrement_by = max(n // 10, 10)
+    while (size >= max_size) and (n > 0):
+        n -= decrement_by
+        toss = li[:-n]
+        keep = li[-n:]
+        size = len(repr(keep))
+    return keep, toss
+
+
+def bench_cache_meta():
+    """Record a fragment containing 500 objects, each accessed 20 times."""
+    from ultracache.utils import cache_meta
+
+    recorder = [(1, i) for i in range(500)] * 20
+    number = 20
+    report(
+        "cache_meta, 500 objects",
+        timeit.timeit(lambda: cache_meta(recorder, "key"), number=number),
+        number
+    )
+
+
+def legacy_add(key, cache_key, max_size):
+    # The registry append used before RegistryList
+    from django.core.cache import cache
+
+    v = cache.get(key)
+    keep = []
+    if v is not None:
+        keep, toss = legacy_reduce_list_size(v, max_size)
+        if toss:
+            cache.delete_many(toss)
+    if cache_key not in keep:
+        cache.set(key, keep + [cache_key], 86400)
+
+
+def bench_registry():
+    """Append a cache key to a registry through the cache, end to end."""
+    from unittest import mock
+    from django.core.cache import cache
+    from ultracache.registry import DjangoCacheRegistry
+
+    registry = DjangoCacheRegistry({})
+    for n in (10000, 100000):
+        members = ["ucache-%032x" % i for i in range(n)]
+        number = 10
+        # A registry with room to spare and a full one that is trimmed
+        for label, max_size in (
+            ("", len(repr(members)) * 2), (", full", len(repr(members)))
+        ):
+            cache.set("ucache-1-1", members, 86400)
+
+            def legacy():
+                for i in range(number):
+                    legacy_add("ucache-1-1", "new-%s" % i, max_size)
+
+            report(
+                "legacy list, %s entries%s" % (n, label),
+                timeit.timeit(legacy, number=1),
+                number
+            )
+
+            cache.set("ucache-1-1", members, 86400)
+
+            def add_many():
+                for i in range(number):
+                    registry.add_many({"ucache-1-1": ["new-%s" % i]})
+
+            with mock.patch("ultracache.registry.MAX_SIZE", max_size):
+                report(
+                    "DjangoCacheRegistry, %s entries%s" % (n, label),
+                    timeit.timeit(add_many, number=1),
+                    number
+                )
+
+
+def legacy__getattribute__(self, name):
+    # The always installed patch used before recording scopes
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Model
+    from ultracache import _thread_locals
+
+    if hasattr(_thread_locals, "ultracache_recorder") and \
+        not hasattr(_thread_locals, "_ultracache_attr_marker"):
+        setattr(_thread_locals, "_ultracache_attr_marker", 1)
+        if hasattr(self, "pk"):
+            ct = ContentType.objects.get_for_model(self.__class__)
+            _thread_locals.ultracache_recorder.append((ct.id, self.pk))
+        delattr(_thread_locals, "_ultracache_attr_marker")
+    return super(Model, self).__getattribute__(name)
+
+
+def bench_getattribute():
+    """Read a model field 10000 times outside and inside a recording scope."""
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import DEFAULT_DB_ALIAS
+    from django.db.models import Model
+    from ultracache import _thread_locals
+    from ultracache.recording import recording
+    from ultracache.tests.models import DummyModel
+
+    # Seed the content type cache so no database is needed
+    ContentType.objects._add_to_cache(
+        DEFAULT_DB_ALIAS,
+        ContentType(id=1, app_label="tests", model="dummymodel")
+    )
+    obj = DummyModel(id=1, title="One", code="one")
+    number = 10000
+
+    def read():
+        for i in range(number):
+            obj.title
+
+    _thread_locals.ultracache_recorder = []
+    Model.__getattribute__ = legacy__getattribute__
+    try:
+        report("legacy patch", timeit.timeit(read, number=1), number)
+    finally:
+        del Model.__getattribute__
+        del _thread_locals.ultracache_recorder
+    report("scoped, outside a scope", timeit.timeit(read, number=1), number)
+    with recording():
+        report("scoped, inside a scope", timeit.timeit(read, number=1), number)
+
+
+def legacy_viewset_settings(context, request):
+    # The per request resolution used before ViewsetConfig
+    from django.conf import settings
+
+    viewsets = settings.ULTRACACHE.get("drf", {}).get("viewsets", {})
+    dotted_name = context.__module__ + "." + context.__class__.__name__
+    do_cache = (dotted_name in viewsets) or (context.__class__ in viewsets) \
+        or ("*" in viewsets)
+    li = []
+    if do_cache:
+        viewset_settings = viewsets.get(dotted_name, {}) \
+            or viewsets.get(context.__class__, {}) \
+            or viewsets.get("*", {})
+        evaluate = viewset_settings.get("evaluate", None)
+        if evaluate is not None:
+            li.append(eval(evaluate))
+        li.append(viewset_settings.get("timeout", 300))
+    return li
+
+
+def bench_drf():
+    """Serve a cached viewset list and resolve viewset settings."""
+    from django.conf import settings
+    from django.contrib.auth.models import AnonymousUser
+    from django.test.utils import override_settings
+    from rest_framework.test import APIRequestFactory
+    from ultracache.monkey import get_viewset_config
+    from ultracache.tests.models import DummyModel
+    from ultracache.tests.viewsets import DummyViewSet
+
+    setup_database()
+    for i in range(50):
+        DummyModel.objects.create(title="Title %s" % i, code="code%s" % i)
+
+    ultracache = dict(
+        settings.ULTRACACHE,
+        drf={"viewsets": {"*": {"evaluate": "request.user.is_anonymous"}}}
+    )
+    with override_settings(ULTRACACHE=ultracache, ALLOWED_HOSTS=["*"]):
+        view = DummyViewSet.as_view({"get": "list"})
+        request = APIRequestFactory().get("/api/dummies/")
+        request.user = AnonymousUser()
+        context = DummyViewSet()
+        number = 10000
+        report(
+            "legacy settings resolution",
+            timeit.timeit(
+                lambda: legacy_viewset_settings(context, request),
+                number=number
+            ),
+            number
+        )
+
+        def resolve():
+            config = get_viewset_config(DummyViewSet)
+            config.evaluated(context, request, (), {})
+
+        report(
+            "ViewsetConfig resolution",
+            timeit.timeit(resolve, number=number),
+            number
+        )
+
+        number = 500
+        view(request).render()
+        report(
+            "cached list of 50 objects",
+            timeit.timeit(lambda: view(request), number=number),
+            number
+        )
+
+
+def legacy_cache_key(view_func, view_or_request, params, args, kwargs):
+    # The per request cache key computation used before CacheKey
+    import hashlib
+    from django.conf import settings
+    from ultracache.utils import get_current_site_pk
+
+    request = getattr(view_or_request, "request", view_or_request)
+    if request.method.lower() not in ("get", "head"):
+        return None
+    l = 0
+    try:
+        l = len(request._messages)
+    except (AttributeError, TypeError):
+        pass
+    if l:
+        return None
+    li = [str(view_or_request.__class__), view_func.__name__]
+    if not set(params).intersection(set((
+        "request.get_full_path()", "request.path", "request.path_info"
+    ))):
+        li.append(request.get_full_path())
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        li.append(get_current_site_pk(request))
+    keys = list(kwargs.keys())
+    keys.sort()
+    for key in keys:
+        li.append("%s,%s" % (key, kwargs[key]))
+    for param in params:
+        if not isinstance(param, str):
+            param = str(param)
+        li.append(eval(param))
+    s = ":".join([str(l) for l in li])
+    return "ucache-%s" % hashlib.md5(s.encode("utf-8")).hexdigest()
+
+
+def bench_decorators():
+    """Serve a view decorated with ultracache from the cache."""
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from django.test.utils import override_settings
+    from django.views.generic import View
+    from ultracache.decorators import CacheKey, ultracache
+
+    setup_database()
+    params = ("request.is_secure()", 456)
+
+    class PlainView(View):
+        def get(self, request, *args, **kwargs):
+            return HttpResponse("content")
+
+    view = ultracache(300, *params)(PlainView)
+    with override_settings(ALLOWED_HOSTS=["*"]):
+        request = RequestFactory().get("/cached/?page=1")
+        instance = view()
+        instance.request = request
+        get = PlainView.get
+        number = 10000
+        report(
+            "legacy cache key",
+            timeit.timeit(
+                lambda: legacy_cache_key(get, instance, params, (), {}),
+                number=number
+            ),
+            number
+        )
+        cache_key = CacheKey(get, params)
+        report(
+            "CacheKey",
+            timeit.timeit(lambda: cache_key(instance, (), {}), number=number),
+            number
+        )
+        as_view = view.as_view()
+        as_view(request)
+        seconds = timeit.timeit(lambda: as_view(request), number=number)
+        report("cached view", seconds, number)
+        print("%-50s %10.0f" % ("cached view, requests per second",
+                                number / seconds))
+
+
+BENCHMARKS = {
+    "cache_meta": bench_cache_meta,
+    "decorators": bench_decorators,
+    "drf": bench_drf,
+    "getattribute": bench_getattribute,
+    "registry": bench_registry,
+}
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [benchmark ...]")
+    (options, args) = parser.parse_args()
+    for name in (args or sorted(BENCHMARKS.keys())):
+        print("%s: %s" % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
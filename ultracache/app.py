@@ -1,4 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.db.models.signals import post_migrate
+
+
+def on_post_migrate(**kwargs):
+    # Content type ids may change when migrating, eg. a test database
+    from ultracache import contenttypes
+    contenttypes.clear()
 
 
 class UltracacheAppConfig(AppConfig):
@@ -6,4 +16,12 @@ class UltracacheAppConfig(AppConfig):
     verbose_name = "Ultracache"
 
     def ready(self):
-        from ultracache import signals
+        from ultracache import contenttypes, signals
+        post_migrate.connect(on_post_migrate)
+        if getattr(settings, "ULTRACACHE", {}).get("warm-content-types", True):
+            try:
+                contenttypes.warm()
+            except (DatabaseError, ImproperlyConfigured):
+                # Eg. the database has not been migrated yet. Content type ids
+                # are then looked up on first use.
+                pass
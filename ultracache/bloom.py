@@ -0,0 +1,289 @@
+"""A Bloom filter of the objects and content types that have been recorded in
+the registry. The signal handlers consult it so saving an object that is not
+in any cache entry does not cost any registry round trips.
+
+The filter is shared through Django's cache and every process keeps a copy.
+A Bloom filter never gives false negatives, so the shared filter is only
+trusted once it is older than the registry timeout (the warmup), because
+registries written before it was created are not represented in it. The same
+holds for a new generation of the filter, which is started when the shared
+state was partly evicted."""
+
+import hashlib
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class BloomFilter:
+
+    def __init__(self, capacity=100000, error_rate=0.01, bits=None):
+        self.size = int(
+            math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        if bits is None:
+            bits = bytearray((self.size + 7) // 8)
+        self.bits = bytearray(bits)
+
+    def _positions(self, item):
+        digest = hashlib.md5(item.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, other):
+        for i, byte in enumerate(other.bits):
+            self.bits[i] |= byte
+
+
+def object_item(ctid, pk):
+    return "%s-%s" % (ctid, pk)
+
+
+def content_type_item(ctid):
+    return "ct-%s" % ctid
+
+
+class SharedBloomFilter:
+    """Keep an in-process copy of the filter stored in Django's cache.
+
+    Publishing increments the version and stores the new items as a small
+    delta under that version. Processes catch up by applying the deltas
+    between their version and the current one. Every compact versions the
+    deltas are folded into the stored filter, so the whole filter is only
+    transferred when a process starts or falls far behind."""
+
+    key = "ucache-bloom"
+    version_key = "ucache-bloom-version"
+    lock_key = "ucache-bloom-lock"
+    delta_key = "ucache-bloom-delta-%s"
+
+    def __init__(self, options):
+        self.capacity = options.get("capacity", 100000)
+        self.error_rate = options.get("error-rate", 0.01)
+        # Negative lookups are always confirmed against the version. This is
+        # how long add_many trusts the local copy for filtering, and how long
+        # a missing filter is not looked for again.
+        self.refresh = options.get("refresh", 1)
+        self.warmup = options.get("warmup", 86400)
+        self.lease = options.get("lease", 2)
+        self.compact = options.get("compact", 100)
+        # Processes further behind than this reload the stored filter
+        self.limit = 5 * self.compact
+        self.local = None
+        self.created = None
+        self.version = None
+        self.missing = set()
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def _forget(self):
+        self.local = self.created = self.version = None
+        self.missing = set()
+
+    def _catch_up(self, version):
+        """Apply the deltas published since the local version. Return False
+        if a delta that must exist by now is missing."""
+        slots = sorted(self.missing) \
+            + list(range(self.version + 1, version + 1))
+        self.missing = set()
+        self.version = version
+        if not slots:
+            return True
+        keys = [self.delta_key % n for n in slots]
+        deltas = cache.get_many(keys)
+        for n, key in zip(slots, keys):
+            if key in deltas:
+                for item in deltas[key]:
+                    self.local.add(item)
+            else:
+                # Publishers set the delta right after incrementing the
+                # version, so it may not be there yet
+                self.missing.add(n)
+        return not [n for n in self.missing if n <= version - self.compact]
+
+    def _reload(self, version):
+        data = cache.get(self.key)
+        if (data is None) or (version < data["version"]) \
+                or (version - data["version"] > self.limit):
+            self._forget()
+            return
+        self.local = BloomFilter(self.capacity, self.error_rate, data["bits"])
+        self.created = data["created"]
+        self.version = data["version"]
+        self.missing = set()
+        if not self._catch_up(version):
+            self._forget()
+
+    def _refresh(self, now):
+        self.checked = now
+        version = cache.get(self.version_key)
+        if version is None:
+            self._forget()
+        elif (self.local is not None) \
+                and (self.version <= version <= self.version + self.limit) \
+                and self._catch_up(version):
+            return
+        else:
+            self._reload(version)
+
+    def _trusted(self, now):
+        return (self.local is not None) and (now - self.created >= self.warmup)
+
+    def might_contain(self, item):
+        """Return False only if item was certainly never added."""
+        now = time.time()
+        with self.lock:
+            if (self.local is None) and (now - self.checked >= self.refresh):
+                self._refresh(now)
+            if (not self._trusted(now)) or (item in self.local):
+                return True
+            # Another process may have added item since the last refresh
+            self._refresh(now)
+            return (not self._trusted(now)) or (item in self.local)
+
+    def _reset(self):
+        """Start a new generation of the shared filter. Like a new filter it
+        is only trusted once it is older than the warmup."""
+        # Start at a random value so the version never reverts to one that a
+        # process already has
+        version = random.getrandbits(48)
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        created = time.time()
+        cache.set(
+            self.key,
+            {
+                "bits": bytes(bloom.bits), "created": created,
+                "version": version
+            },
+            None
+        )
+        cache.set(self.version_key, version, None)
+        self.local, self.created, self.version = bloom, created, version
+        self.missing = set()
+
+    def _initialize(self):
+        """Create the shared filter unless another process beats us to it.
+        Wait for at most the lease, after which a stale lock expires."""
+        deadline = time.time() + self.lease + 1
+        acquired = cache.add(self.lock_key, 1, self.lease)
+        while not acquired and (time.time() < deadline):
+            time.sleep(0.01)
+            acquired = cache.add(self.lock_key, 1, self.lease)
+        try:
+            if cache.get(self.version_key) is None:
+                self._reset()
+        finally:
+            if acquired:
+                cache.delete(self.lock_key)
+
+    def _compact(self, version):
+        """Fold the deltas up to version into the stored filter. A process
+        that can't get the lock skips compacting since another one is busy
+        with it. If a delta was lost a new generation is started."""
+        if not cache.add(self.lock_key, 1, self.lease):
+            return
+        try:
+            data = cache.get(self.key)
+            if (data is not None) and (version <= data["version"]):
+                return
+            if (data is None) or (version - data["version"] > self.limit):
+                self._reset()
+                return
+            keys = [
+                self.delta_key % n
+                for n in range(data["version"] + 1, version + 1)
+            ]
+            deltas = cache.get_many(keys)
+            if len(deltas) != len(keys):
+                self._reset()
+                return
+            bloom = BloomFilter(self.capacity, self.error_rate, data["bits"])
+            for items in deltas.values():
+                for item in items:
+                    bloom.add(item)
+            cache.set(
+                self.key,
+                {
+                    "bits": bytes(bloom.bits), "created": data["created"],
+                    "version": version
+                },
+                None
+            )
+            cache.delete_many(keys)
+        finally:
+            cache.delete(self.lock_key)
+
+    def add_many(self, items):
+        """Publish the items that are not present yet."""
+        now = time.time()
+        with self.lock:
+            # Filtering against an outdated copy only publishes items again.
+            # A copy of an older generation is outdated for at most refresh
+            # seconds, well within the warmup of the new generation.
+            if now - self.checked >= self.refresh:
+                self._refresh(now)
+            if self.local is not None:
+                items = [item for item in items if item not in self.local]
+            if not items:
+                return
+
+            try:
+                version = cache.incr(self.version_key)
+            except ValueError:
+                self._initialize()
+                version = cache.incr(self.version_key)
+            cache.set(self.delta_key % version, items, None)
+            if self.local is not None:
+                for item in items:
+                    self.local.add(item)
+
+            # Leave the deltas of publishers that are still busy alone
+            if version % self.compact == 0:
+                self._compact(version - self.compact)
+
+
+def load_bloom():
+    try:
+        options = settings.ULTRACACHE["bloom"]
+    except (AttributeError, KeyError):
+        return None
+    return SharedBloomFilter(options)
+
+
+_bloom = None
+_loaded = False
+
+
+def get_bloom():
+    """Return the shared filter or None if it is not configured."""
+    global _bloom, _loaded
+    if not _loaded:
+        _bloom = load_bloom()
+        _loaded = True
+    return _bloom
+
+
+@receiver(setting_changed)
+def on_setting_changed(sender, setting, **kwargs):
+    global _bloom, _loaded
+    if setting == "ULTRACACHE":
+        _bloom = None
+        _loaded = False
@@ -0,0 +1,55 @@
+"""Map model classes to content type ids. Every recorded object needs the id
+of its content type, so the map is warmed when the app is ready and a lookup
+is a single dictionary read. Models missing from the map, eg. because their
+content type was created later, are looked up and added on first use."""
+
+import logging
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+
+from ultracache import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Model class to content type id. Proxy models map to the content type of
+# their concrete model, like ContentType.objects.get_for_model.
+content_type_ids = {}
+
+
+def content_type_id(model):
+    try:
+        return content_type_ids[model]
+    except KeyError:
+        # get_for_model itself is cached
+        ct_id = content_type_ids[model] = \
+            ContentType.objects.get_for_model(model).id
+        return ct_id
+
+
+def warm():
+    """Load the content type ids of all installed models with one query.
+    Return the number of models that were mapped."""
+    started = time.time()
+    models = {}
+    for model in apps.get_models(include_auto_created=True):
+        opts = model._meta.concrete_model._meta
+        models.setdefault((opts.app_label, opts.model_name), []).append(model)
+    ids = {}
+    for ct_id, app_label, model_name in ContentType.objects.values_list(
+            "id", "app_label", "model"):
+        for model in models.get((app_label, model_name), []):
+            ids[model] = ct_id
+    content_type_ids.update(ids)
+    duration = time.time() - started
+    metrics.incr("content-types-warmup-seconds", duration)
+    logger.info(
+        "Warmed %s content type ids in %.1f ms", len(ids), duration * 1000
+    )
+    return len(ids)
+
+
+def clear():
+    content_type_ids.clear()
@@ -1,104 +1,224 @@
+import asyncio
 import hashlib
+import time
 import types
 from functools import wraps
 
 from django.conf import settings
-from django.core.cache import cache
 from django.http import HttpResponse
 from django.template.response import TemplateResponse
 from django.utils.decorators import available_attrs
 from django.views.generic.base import TemplateResponseMixin
 
-from ultracache import _thread_locals
-from ultracache.utils import cache_meta, get_current_site_pk
-
-
-def cached_get(timeout, *params):
-    """Decorator applied specifically to a view's get method"""
+from ultracache.recording import recording
+from ultracache.utils import cache_lookup, cache_meta, cache_set, \
+    get_current_site_pk, regenerate_in_task, regenerate_in_thread, \
+    release_lock, run_async, stale_in_background
+
+
+PATH_PARAMS = (
+    "request.get_full_path()", "request.path", "request.path_info"
+)
+
+
+def compile_param(param):
+    """Return a callable of view_or_request, request, args and kwargs for a
+    parameter. Callable parameters are called with request, *args and
+    **kwargs. Other parameters are code that may refer to view_or_request,
+    request, args and kwargs."""
+    if callable(param):
+        return lambda view_or_request, request, args, kwargs: \
+            param(request, *args, **kwargs)
+    code = compile(str(param), "<cached_get param>", "eval")
+    return lambda view_or_request, request, args, kwargs: eval(
+        code, globals(),
+        {
+            "view_or_request": view_or_request, "request": request,
+            "args": args, "kwargs": kwargs
+        }
+    )
+
+
+class CacheKey:
+    """Compute the cache keys for calls of a view. The parameters are compiled
+    once."""
+
+    def __init__(self, view_func, params):
+        self.name = view_func.__name__
+        self.params = [compile_param(param) for param in params]
+
+        # request.get_full_path is implicitly added it no other request path
+        # is provided. get_full_path includes the querystring and is the more
+        # conservative approach but makes it trivially easy for a request to
+        # bust through the cache.
+        self.full_path = not [p for p in params if p in PATH_PARAMS]
+
+    def __call__(self, view_or_request, args, kwargs):
+        """Return a tuple (request, cache_key). The cache key is None if the
+        response must not be cached."""
+
+        # The type of the request gets muddled when using a function based
+        # decorator. We must use a function based decorator so it can be used
+        # in urls.py.
+        request = getattr(view_or_request, "request", view_or_request)
+
+        # If request not GET or HEAD never cache
+        if request.method not in ("GET", "HEAD"):
+            return request, None
+
+        # If request contains messages never cache
+        try:
+            if len(request._messages):
+                return request, None
+        except (AttributeError, TypeError):
+            pass
+
+        li = [str(view_or_request.__class__), self.name]
+        if self.full_path:
+            li.append(request.get_full_path())
+
+        if "django.contrib.sites" in settings.INSTALLED_APPS:
+            li.append(get_current_site_pk(request))
+
+        # Pre-sort kwargs
+        for key in sorted(kwargs):
+            li.append("%s,%s" % (key, kwargs[key]))
+
+        # Extend cache key with custom variables
+        for param in self.params:
+            li.append(param(view_or_request, request, args, kwargs))
+
+        s = ":".join([str(l) for l in li])
+        hashed = hashlib.md5(s.encode("utf-8")).hexdigest()
+        return request, "ucache-%s" % hashed
+
+
+def response_content(response):
+    """Return the content of a response, or None if it can't be cached."""
+    if isinstance(response, TemplateResponse):
+        return response.render().rendered_content
+    elif isinstance(response, HttpResponse):
+        return response.content
+    return None
+
+
+def cache_response(request, cache_key, timeout, frame, response, content,
+                   delta):
+    headers = getattr(response, "_headers", {})
+    objects = cache_meta(frame, cache_key, request=request)
+    cache_set(
+        cache_key,
+        {"content": content, "headers": headers},
+        timeout,
+        objects,
+        delta=delta
+    )
+
+
+def cached_response(cached):
+    response = HttpResponse(cached["content"])
+    # Headers has a non-obvious format
+    for k, v in cached["headers"].items():
+        response[v[0]] = v[1]
+    return response
+
+
+def cached_get(timeout, *params, lock=False):
+    """Decorator applied specifically to a view's get method. With lock=True
+    only one request renders a missing view and others wait for it. Coroutine
+    views are supported as well."""
 
     def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            return async_decorator(view_func)
+        get_cache_key = CacheKey(view_func, params)
+
         @wraps(view_func, assigned=available_attrs(view_func))
         def _wrapped_view(view_or_request, *args, **kwargs):
+            request, cache_key = get_cache_key(view_or_request, args, kwargs)
+            if cache_key is None:
+                return view_func(view_or_request, *args, **kwargs)
 
-            # The type of the request gets muddled when using a function based
-            # decorator. We must use a function based decorator so it can be
-            # used in urls.py.
-            request = getattr(view_or_request, "request", view_or_request)
+            def render():
+                started = time.time()
+                with recording() as frame:
+                    response = view_func(view_or_request, *args, **kwargs)
+                    content = response_content(response)
+                if content is not None:
+                    cache_response(
+                        request, cache_key, timeout, frame, response, content,
+                        time.time() - started
+                    )
+                return response
+
+            entry, token, regenerate = cache_lookup(cache_key, lock=lock)
+            if regenerate:
+                if stale_in_background():
+                    regenerate_in_thread(render)
+                else:
+                    entry = None
+            if entry is None:
+                try:
+                    response = render()
+                finally:
+                    if token is not None:
+                        release_lock(cache_key, token)
+            else:
+                response = cached_response(entry.value)
 
-            # If request not GET or HEAD never cache
-            if request.method.lower() not in ("get", "head"):
-                return view_func(view_or_request, *args, **kwargs)
+            return response
 
-            # If request contains messages never cache
-            l = 0
-            try:
-                l = len(request._messages)
-            except (AttributeError, TypeError):
-                pass
-            if l:
-                return view_func(view_or_request, *args, **kwargs)
+        return _wrapped_view
 
-            # Compute a cache key
-            li = [str(view_or_request.__class__), view_func.__name__]
-
-            # request.get_full_path is implicitly added it no other request
-            # path is provided. get_full_path includes the querystring and is
-            # the more conservative approach but makes it trivially easy for a
-            # request to bust through the cache.
-            if not set(params).intersection(set((
-                "request.get_full_path()", "request.path", "request.path_info"
-            ))):
-                li.append(request.get_full_path())
-
-            if "django.contrib.sites" in settings.INSTALLED_APPS:
-                li.append(get_current_site_pk(request))
-
-            # Pre-sort kwargs
-            keys = list(kwargs.keys())
-            keys.sort()
-            for key in keys:
-                li.append("%s,%s" % (key, kwargs[key]))
-
-            # Extend cache key with custom variables
-            for param in params:
-                if not isinstance(param, str):
-                    param = str(param)
-                li.append(eval(param))
-
-            s = ":".join([str(l) for l in li])
-            hashed = hashlib.md5(s.encode("utf-8")).hexdigest()
-            cache_key = "ucache-%s" % hashed
-            cached = cache.get(cache_key, None)
-            if cached is None:
-                # The get view as outermost caller may bluntly set recorder to empty
-                _thread_locals.ultracache_recorder = []
-                response = view_func(view_or_request, *args, **kwargs)
-                content = None
-                if isinstance(response, TemplateResponse):
-                    content = response.render().rendered_content
-                elif isinstance(response, HttpResponse):
-                    content = response.content
+    def async_decorator(view_func):
+        # Cache lookups and writes are run in an executor, see run_async
+        get_cache_key = CacheKey(view_func, params)
+
+        @wraps(view_func, assigned=available_attrs(view_func))
+        async def _wrapped_view(view_or_request, *args, **kwargs):
+            request, cache_key = get_cache_key(view_or_request, args, kwargs)
+            if cache_key is None:
+                return await view_func(view_or_request, *args, **kwargs)
+
+            async def render():
+                started = time.time()
+                with recording() as frame:
+                    response = await view_func(
+                        view_or_request, *args, **kwargs
+                    )
+                    content = await run_async(response_content, response)
                 if content is not None:
-                    headers = getattr(response, "_headers", {})
-                    cache.set(
-                        cache_key,
-                        {"content": content, "headers": headers},
-                        timeout
+                    await run_async(
+                        cache_response, request, cache_key, timeout, frame,
+                        response, content, time.time() - started
                     )
-                    cache_meta(_thread_locals.ultracache_recorder, cache_key, request=request)
+                return response
+
+            entry, token, regenerate = await run_async(
+                cache_lookup, cache_key, lock
+            )
+            if regenerate:
+                if stale_in_background():
+                    regenerate_in_task(render)
+                else:
+                    entry = None
+            if entry is None:
+                try:
+                    response = await render()
+                finally:
+                    if token is not None:
+                        await run_async(release_lock, cache_key, token)
             else:
-                response = HttpResponse(cached["content"])
-                # Headers has a non-obvious format
-                for k, v in cached["headers"].items():
-                    response[v[0]] = v[1]
+                response = cached_response(entry.value)
 
             return response
 
         return _wrapped_view
+
     return decorator
 
 
-def ultracache(timeout, *params):
+def ultracache(timeout, *params, lock=False):
     """Decorator applied to a view class. The get method is decorated
     implicitly."""
 
@@ -107,9 +227,16 @@ def ultracache(timeout, *params):
             def __init__(self, *args, **kwargs):
                 super(WrappedClass, self).__init__(*args, **kwargs)
 
-            @cached_get(timeout, *params)
-            def get(self, *args, **kwargs):
-                return super(WrappedClass, self).get(*args, **kwargs)
+            if asyncio.iscoroutinefunction(cls.get):
+                @cached_get(timeout, *params, lock=lock)
+                async def get(self, *args, **kwargs):
+                    return await super(WrappedClass, self).get(
+                        *args, **kwargs
+                    )
+            else:
+                @cached_get(timeout, *params, lock=lock)
+                def get(self, *args, **kwargs):
+                    return super(WrappedClass, self).get(*args, **kwargs)
 
         return WrappedClass
     return decorator
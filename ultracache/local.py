@@ -0,0 +1,162 @@
+"""An in-process cache in front of Django's cache. Fragments that are
+rendered on every request, eg. headers and footers, are then served without a
+network round trip.
+
+Every process keeps its own local cache, so the signal handlers publish the
+expired cache keys on a broadcast channel that every process subscribes to.
+Entries are also only kept for a short timeout, which bounds how long a
+missed message can leave a stale entry behind."""
+
+import json
+import pickle
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ultracache.registry import importer, redis_client
+
+
+class LocalBroadcast:
+    """Deliver messages to the subscribers in this process only. Suitable for
+    a single process and for tests."""
+
+    subscribers = {}
+
+    def __init__(self, options):
+        self.channel = options.get("channel", "ultracache")
+
+    def publish(self, keys):
+        for ref in list(self.subscribers.get(self.channel, [])):
+            callback = ref()
+            if callback is not None:
+                callback(keys)
+
+    def subscribe(self, callback):
+        # Hold bound methods weakly so discarded caches are not kept alive
+        self.subscribers.setdefault(self.channel, []).append(
+            weakref.WeakMethod(callback)
+        )
+
+
+class RedisBroadcast:
+    """Deliver messages to all processes with Redis pub/sub. Each process
+    listens in a daemon thread."""
+
+    def __init__(self, options):
+        self.channel = options.get("channel", "ultracache")
+        self.client = redis_client(options)
+        self.thread = None
+
+    def publish(self, keys):
+        self.client.publish(self.channel, json.dumps(keys))
+
+    def subscribe(self, callback):
+        def handler(message):
+            callback(json.loads(message["data"]))
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: handler})
+        self.thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+class LocalCache:
+    """A least recently used cache with a budget in bytes. The size of a value
+    is the size of its pickle."""
+
+    def __init__(self, options):
+        self.max_size = options.get("max-size", 10485760)
+        self.timeout = options.get("timeout", 60)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        broadcast_options = options.get("broadcast", {})
+        klass = importer(
+            broadcast_options.get("backend", "ultracache.local.LocalBroadcast")
+        )
+        self.broadcast = klass(broadcast_options)
+        self.broadcast.subscribe(self.invalidate)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return default
+            value, size, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                self.size -= size
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if size > self.max_size:
+            return
+        if timeout:
+            timeout = min(timeout, self.timeout)
+        else:
+            timeout = self.timeout
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self.entries[key] = (value, size, time.time() + timeout)
+            self.size += size
+            while self.size > self.max_size:
+                k, entry = self.entries.popitem(last=False)
+                self.size -= entry[1]
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+
+    def expire(self, keys):
+        """Invalidate cache keys in this and all other processes."""
+        self.invalidate(keys)
+        self.broadcast.publish(keys)
+
+
+def load_local_cache():
+    try:
+        options = settings.ULTRACACHE["local"]
+    except (AttributeError, KeyError):
+        return None
+    if settings.ULTRACACHE.get("generations", False):
+        raise RuntimeError(
+            "local has a value but generations do not expire cache keys, so \
+the local cache can't be invalidated"
+        )
+    return LocalCache(options)
+
+
+_local_cache = None
+_loaded = False
+
+
+def get_local_cache():
+    """Return the local cache or None if it is not configured."""
+    global _local_cache, _loaded
+    if not _loaded:
+        _local_cache = load_local_cache()
+        _loaded = True
+    return _local_cache
+
+
+@receiver(setting_changed)
+def on_setting_changed(sender, setting, **kwargs):
+    global _local_cache, _loaded
+    if setting == "ULTRACACHE":
+        _local_cache = None
+        _loaded = False
@@ -0,0 +1,30 @@
+"""In-process counters, eg. for regeneration lock waits. Read them with
+snapshot and export them to a monitoring system as required."""
+
+import threading
+from collections import Counter
+
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def get(name):
+    with _lock:
+        return _counters[name]
+
+
+def snapshot():
+    """Return a copy of all counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
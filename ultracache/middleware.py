@@ -0,0 +1,49 @@
+from django.conf import settings
+
+from ultracache.utils import RegistryBuffer, current_buffer
+
+
+class BufferFlusher:
+    """Django calls close on this object once the response has been sent."""
+
+    def __init__(self, buffer, background=False):
+        self.buffer = buffer
+        self.background = background
+
+    def close(self):
+        if self.background:
+            self.buffer.flush_in_thread()
+        else:
+            self.buffer.flush()
+
+
+class RegistryBufferMiddleware:
+    """Buffer the registry appends of all template tags, decorators and
+    Ultracache objects during a request and write them once the response has
+    been sent."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        try:
+            self.background = settings.ULTRACACHE["buffer"]["background"]
+        except (AttributeError, KeyError):
+            self.background = False
+
+    def __call__(self, request):
+        # Defer to an outer buffer
+        if current_buffer.get() is not None:
+            return self.get_response(request)
+
+        buffer = RegistryBuffer()
+        current_buffer.set(buffer)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            current_buffer.set(None)
+            buffer.flush()
+            raise
+        current_buffer.set(None)
+        response._closable_objects.append(
+            BufferFlusher(buffer, background=self.background)
+        )
+        return response
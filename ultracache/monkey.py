@@ -4,19 +4,22 @@ Django 1.11 but is backwards compatible with 1.9."""
 
 import hashlib
 import inspect
-import pickle
 import types
 from collections import OrderedDict
 
-from django.core.cache import cache
-from django.db.models import Model, Manager
+from django.core.signals import setting_changed
+from django.db.models import Model
+from django.http import HttpResponse
 from django.template.base import Variable, VariableDoesNotExist
 from django.template.context import BaseContext
-from django.contrib.contenttypes.models import ContentType
+from django.utils.http import urlencode
 from django.conf import settings
+from django.dispatch import receiver
 
-from ultracache import _thread_locals
-from ultracache.utils import cache_meta, get_current_site_pk
+from ultracache.contenttypes import content_type_id
+from ultracache.recording import in_scope, record_many, recording
+from ultracache.utils import cache_lookup, cache_meta, cache_set, \
+    get_current_site_pk
 
 try:
     from django.template.base import logger
@@ -80,9 +83,9 @@ def my_resolve_lookup(self, context):
                                 raise
                 elif isinstance(current, Model):
                     if ("request" in context) and hasattr(context["request"], "_ultracache"):
-                        # get_for_model itself is cached
-                        ct = ContentType.objects.get_for_model(current.__class__)
-                        context["request"]._ultracache.append((ct.id, current.pk))
+                        context["request"]._ultracache.append(
+                            (content_type_id(current.__class__), current.pk)
+                        )
 
         except Exception as e:
             template_name = getattr(context, "template_name", None) or "unknown"
@@ -108,41 +111,113 @@ Variable._resolve_lookup = my_resolve_lookup
 conceptually the same as templates but make it even easier to track objects."""
 try:
     from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
-    from rest_framework.response import Response
-    from rest_framework.serializers import Serializer, ListSerializer
+    from rest_framework.serializers import Serializer
     HAS_DRF = True
 except ImportError:
     HAS_DRF = False
 
 
+class ViewsetConfig:
+    """The caching settings of a viewset class, resolved once. A string
+    evaluate is compiled and may refer to context, request, args and
+    kwargs."""
+
+    def __init__(self, viewset_settings):
+        self.timeout = viewset_settings.get("timeout", 300)
+        self.query_params = viewset_settings.get("query-params", None)
+        if self.query_params is not None:
+            self.query_params = frozenset(self.query_params)
+        self.sites = "django.contrib.sites" in settings.INSTALLED_APPS
+        self.evaluate = viewset_settings.get("evaluate", None)
+        self.code = None
+        if (self.evaluate is not None) and not callable(self.evaluate):
+            self.code = compile(self.evaluate, "<ultracache evaluate>", "eval")
+
+    def cache_path(self, request):
+        """Return the path of request with a canonical query string. The
+        parameters are sorted by name, and if query-params is set the others
+        are dropped."""
+        query = request.query_params
+        params = [
+            (k, v) for k in sorted(query.keys())
+            if (self.query_params is None) or (k in self.query_params)
+            for v in query.getlist(k)
+        ]
+        if not params:
+            return request.path
+        return request.path + "?" + urlencode(params)
+
+    def evaluated(self, context, request, args, kwargs):
+        if self.code is not None:
+            return eval(
+                self.code, globals(),
+                {
+                    "context": context, "request": request, "args": args,
+                    "kwargs": kwargs
+                }
+            )
+        return self.evaluate(context, request)
+
+
+_viewset_configs = {}
+
+
+def get_viewset_config(klass):
+    """Return the ViewsetConfig for a viewset class, or None if it is not
+    cached."""
+    try:
+        return _viewset_configs[klass]
+    except KeyError:
+        pass
+    viewsets = settings.ULTRACACHE.get("drf", {}).get("viewsets", {})
+    dotted_name = klass.__module__ + "." + klass.__name__
+    config = None
+    if (dotted_name in viewsets) or (klass in viewsets) or ("*" in viewsets):
+        config = ViewsetConfig(
+            viewsets.get(dotted_name, {}) or viewsets.get(klass, {})
+            or viewsets.get("*", {})
+        )
+    _viewset_configs[klass] = config
+    return config
+
+
+@receiver(setting_changed)
+def on_setting_changed(sender, setting, **kwargs):
+    if setting == "ULTRACACHE":
+        _viewset_configs.clear()
+
+
 def drf_cache(func):
 
     def wrapped(context, request, *args, **kwargs):
-        viewsets = settings.ULTRACACHE.get("drf", {}).get("viewsets", {})
-        dotted_name =  context.__module__ + "." + context.__class__.__name__
-        do_cache = (dotted_name in viewsets) or (context.__class__ in viewsets) or ("*" in viewsets)
+        config = get_viewset_config(context.__class__)
+        do_cache = config is not None
 
         if do_cache:
-            li = [request.get_full_path()]
-            viewset_settings = viewsets.get(dotted_name, {}) \
-                or viewsets.get(context.__class__, {}) \
-                or viewsets.get("*", {})
-            evaluate = viewset_settings.get("evaluate", None)
-            if evaluate is not None:
-                if callable(evaluate):
-                    li.append(evaluate(context, request))
-                else:
-                    li.append(eval(evaluate))
-
-            if "django.contrib.sites" in settings.INSTALLED_APPS:
+            li = [config.cache_path(request)]
+            if config.evaluate is not None:
+                li.append(config.evaluated(context, request, args, kwargs))
+
+            if config.sites:
                 li.append(get_current_site_pk(request))
 
+            # Each negotiated media type is rendered and cached separately
+            li.append(getattr(request, "accepted_media_type", ""))
+
             s = ":".join([str(l) for l in li])
             cache_key = hashlib.md5(s.encode("utf-8")).hexdigest()
 
-            cached = cache.get(cache_key, None)
-            if cached is not None:
-                response = Response(pickle.loads(cached["content"]))
+            # A stale entry is regenerated by the one reader that gets
+            # regenerate, in the request itself.
+            entry, token, regenerate = cache_lookup(cache_key)
+            cached = entry.value if (entry is not None) else None
+            if (cached is not None) and ("status" in cached) \
+                    and not regenerate:
+                # Serve the rendered body so neither serializers nor renderers
+                # run again.
+                response = HttpResponse(
+                    cached["content"], status=cached["status"]
+                )
 
                 # Headers has a non-obvious format
                 for k, v in cached["headers"].items():
@@ -154,76 +229,44 @@ def drf_cache(func):
             setattr(request, "_ultracache", [])
             setattr(request, "_ultracache_cache_key_range", [])
 
-        response = func(context, request, *args, **kwargs)
-
-        if do_cache:
-            cache_meta(_thread_locals.ultracache_recorder, cache_key, request=request)
-            response = context.finalize_response(request, response, *args, **kwargs)
-            response.render()
-            timeout = viewset_settings.get("timeout", 300)
-            headers = getattr(response, "_headers", {})
-            cache.set(
-                cache_key,
-                {"content": pickle.dumps(response.data), "headers": headers},
-                timeout
-            )
-            return response
-
-        else:
-            return response
+        if not do_cache:
+            return func(context, request, *args, **kwargs)
+
+        with recording() as frame:
+            response = func(context, request, *args, **kwargs)
+
+        objects = cache_meta(frame, cache_key, request=request)
+        response = context.finalize_response(request, response, *args, **kwargs)
+        response.render()
+        headers = getattr(response, "_headers", {})
+        cache_set(
+            cache_key,
+            {
+                "content": response.content,
+                "status": response.status_code,
+                "headers": headers
+            },
+            config.timeout,
+            objects
+        )
+        return response
 
     return wrapped
 
 
 def _serializer(func):
-    # Helper decorator for Serializer
+    # Helper decorator for Serializer. ListSerializer calls it for each item
+    # while it evaluates its data, so lists need no patch of their own.
 
     def wrapped(context, instance):
-        request = context.context["request"]
-        if hasattr(request, "_ultracache") and isinstance(instance, Model):
-            ct = ContentType.objects.get_for_model(instance.__class__)
-            request._ultracache.append((ct.id, instance.pk))
+        if isinstance(instance, Model) and in_scope():
+            record_many([(content_type_id(instance.__class__), instance.pk)])
         return func(context, instance)
 
     return wrapped
 
 
-def _listserializer(func):
-    # Helper decorator for ListSerializer
-
-    def wrapped(context, data):
-        request = context.context["request"]
-        if hasattr(request, "_ultracache"):
-            iterable = data.all() if isinstance(data, Manager) else data
-            for obj in iterable:
-                if isinstance(obj, Model):
-                    ct = ContentType.objects.get_for_model(obj.__class__)
-                    request._ultracache.append((ct.id, obj.pk))
-        return func(context, data)
-
-    return wrapped
-
-
 if HAS_DRF:
     ListModelMixin.list = drf_cache(ListModelMixin.list)
     RetrieveModelMixin.retrieve = drf_cache(RetrieveModelMixin.retrieve)
     Serializer.to_representation = _serializer(Serializer.to_representation)
-    ListSerializer.to_representation = _listserializer(ListSerializer.to_representation)
-
-
-# Dark magic enables us to record object access. This enables us keep track of
-# objects accessed in any Python code and not just in the templates being
-# rendered.
-
-def my__getattribute__(self, name):
-    if hasattr(_thread_locals, "ultracache_recorder") and \
-        not hasattr(_thread_locals, "_ultracache_attr_marker"):
-        setattr(_thread_locals, "_ultracache_attr_marker", 1)
-        if hasattr(self, "pk"):
-            # get_for_model itself is cached
-            ct = ContentType.objects.get_for_model(self.__class__)
-            _thread_locals.ultracache_recorder.append((ct.id, self.pk))
-        delattr(_thread_locals, "_ultracache_attr_marker")
-    return super(Model, self).__getattribute__(name)
-
-Model.__getattribute__ = my__getattribute__
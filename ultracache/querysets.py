@@ -0,0 +1,59 @@
+"""QuerySet.update, bulk_create and bulk_update don't send signals, so cache
+keys affected by them are not expired. Use UltracacheQuerySet or
+UltracacheManager on models that are modified in bulk::
+
+    class MyModel(models.Model):
+        objects = UltracacheManager()
+
+Each bulk operation then expires all affected cache keys in one batch."""
+
+from django.db import models
+
+from ultracache.signals import expire_content_type, expire_objects, \
+    invalidation_batch
+
+
+class UltracacheQuerySetMixin:
+
+    def update(self, **kwargs):
+        # Fetch primary keys first because the update may change the filter
+        pks = list(self.values_list("pk", flat=True))
+        result = super(UltracacheQuerySetMixin, self).update(**kwargs)
+        if pks:
+            expire_objects(
+                self.model, pks, using=self.db, fields=list(kwargs.keys())
+            )
+        return result
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        result = super(UltracacheQuerySetMixin, self).bulk_create(
+            objs, *args, **kwargs
+        )
+        if result:
+            expire_content_type(self.model, using=self.db)
+        return result
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        result = super(UltracacheQuerySetMixin, self).bulk_update(
+            objs, fields, *args, **kwargs
+        )
+        pks = [obj.pk for obj in objs]
+        if pks:
+            expire_objects(self.model, pks, using=self.db, fields=fields)
+        return result
+    bulk_update.alters_data = True
+
+    def delete(self):
+        # Delete sends post_delete for every object. Expire them all at once.
+        with invalidation_batch(using=self.db):
+            return super(UltracacheQuerySetMixin, self).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class UltracacheQuerySet(UltracacheQuerySetMixin, models.QuerySet):
+    pass
+
+
+UltracacheManager = models.Manager.from_queryset(UltracacheQuerySet)
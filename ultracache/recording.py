@@ -0,0 +1,253 @@
+"""Record the objects that are accessed while a cache entry is computed.
+
+Model.__getattribute__ is only replaced while at least one recording scope is
+open in the process, so attribute access outside of scopes costs nothing
+extra. Within a scope each instance is recorded once, which is tracked by a
+marker on the instance. The marker holds the id of the frame rather than the
+frame itself, so instances stay small when pickled and don't keep frames
+alive.
+
+The recorder is a stack of frames, one per open scope. When a scope closes its
+objects are merged into the enclosing frame, and the stack is empty once the
+outermost scope closes. The stack is a tuple in a context variable, so
+coroutines running concurrently in one thread each have their own, while
+tasks started within a scope record into the frames of that scope."""
+
+import itertools
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+from django.conf import settings
+from django.db.models import Model
+
+from ultracache.contenttypes import content_type_id, content_type_ids
+
+
+# Record which fields are read from objects so saves that only touch other
+# fields don't expire anything.
+try:
+    TRACK_FIELDS = settings.ULTRACACHE["track-fields"]
+except (AttributeError, KeyError):
+    TRACK_FIELDS = False
+
+MARKER = "_ultracache_scope"
+
+
+class ThreadLocalVar(threading.local):
+    """A stand-in for ContextVar on Pythons without contextvars. Concurrent
+    coroutines are then not isolated from each other."""
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        previous, self.value = self.value, value
+        return previous
+
+    def reset(self, token):
+        self.value = token
+
+
+# The stack of frames of the open scopes
+recorder = (ContextVar or ThreadLocalVar)("ultracache_recorder", default=())
+
+_lock = threading.Lock()
+_open_scopes = 0
+
+_field_names = {}
+
+# Frame ids start at a random value so the marker of an instance that was
+# pickled in another process is unlikely to match a frame of this one.
+_frame_ids = itertools.count(random.getrandbits(48))
+
+
+def field_names(model):
+    """Return a dictionary mapping the names and attnames of the concrete
+    fields of model to their names."""
+    try:
+        return _field_names[model]
+    except KeyError:
+        di = {}
+        for field in model._meta.concrete_fields:
+            di[field.name] = field.name
+            di[field.attname] = field.name
+        _field_names[model] = di
+        return di
+
+
+class Frame(OrderedDict):
+    """An insertion ordered set of the objects recorded in one scope. Objects
+    are (ctid, pk) tuples, or (ctid, pk, field) tuples when tracking fields.
+    """
+
+    closed = False
+
+    def __init__(self, *args, **kwargs):
+        super(Frame, self).__init__(*args, **kwargs)
+        self.id = next(_frame_ids)
+        # Worker threads record into the frames of their caller, and frames
+        # are merged while other threads record into them
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            self[item] = None
+
+    def add_many(self, items):
+        with self.lock:
+            for item in items:
+                self[item] = None
+
+    def merge(self, frame):
+        """Add the objects of frame."""
+        with frame.lock:
+            items = list(frame)
+        self.add_many(items)
+
+
+def record(model, pk, field=None):
+    """Add (ctid, pk), or (ctid, pk, field) if field is given, to the
+    innermost scope."""
+    frames = recorder.get()
+    ct_id = content_type_ids.get(model, None)
+    if ct_id is None:
+        # Looking up the content type accesses attributes itself. Those must
+        # not be recorded.
+        token = recorder.set(())
+        try:
+            ct_id = content_type_id(model)
+        finally:
+            recorder.reset(token)
+    if field is None:
+        frames[-1].add((ct_id, pk))
+    else:
+        frames[-1].add((ct_id, pk, field))
+
+
+def record_many(items):
+    """Add objects, eg. those of a cache hit, to the innermost scope if one is
+    open."""
+    frames = recorder.get()
+    if frames:
+        frames[-1].add_many(items)
+
+
+def recording__getattribute__(self, name):
+    frames = recorder.get()
+    if frames:
+        di = object.__getattribute__(self, "__dict__")
+        model = type(self)
+        attname = model._meta.pk.attname
+        # The primary key is absent while the instance is initialized
+        if attname in di:
+            marker = di.get(MARKER, None)
+            if (marker is None) or (marker[0] != frames[-1].id):
+                # The frame id of the innermost scope and the recorded fields
+                marker = di[MARKER] = [frames[-1].id, set()]
+                record(model, di[attname])
+            if TRACK_FIELDS:
+                field = field_names(model).get(name, None)
+                if (field is not None) and (field not in marker[1]):
+                    marker[1].add(field)
+                    record(model, di[attname], field)
+    return object.__getattribute__(self, name)
+
+
+def open_scope():
+    """Start recording in the current context. Return the frame that collects
+    the objects of the scope, which is also the token for close_scope."""
+    global _open_scopes
+    frame = Frame()
+    recorder.set(recorder.get() + (frame,))
+    with _lock:
+        _open_scopes += 1
+        if _open_scopes == 1:
+            Model.__getattribute__ = recording__getattribute__
+    return frame
+
+
+def close_scope(frame):
+    """Stop the recording started by open_scope. The objects of the frame are
+    added to the enclosing scope since they contribute to it as well. Scopes
+    may be closed in any order and more than once. A scope that is closed
+    before scopes opened after it also gets the objects of those scopes,
+    which were accessed while it was open."""
+    global _open_scopes
+    if frame.closed:
+        return
+    frame.closed = True
+    with _lock:
+        _open_scopes -= 1
+        if _open_scopes == 0:
+            del Model.__getattribute__
+    # Frames compare by content so look for this very frame. It is absent if
+    # the scope is closed from another context.
+    frames = recorder.get()
+    for i, f in enumerate(frames):
+        if f is frame:
+            for later in frames[i + 1:]:
+                frame.merge(later)
+            recorder.set(frames[:i] + frames[i + 1:])
+            if i > 0:
+                frames[i - 1].merge(frame)
+            break
+
+
+def in_scope():
+    """Return True if a recording scope is open in the current context."""
+    return bool(recorder.get())
+
+
+@contextmanager
+def recording():
+    """Record objects accessed in the block. Yield the frame the objects are
+    collected in."""
+    frame = open_scope()
+    try:
+        yield frame
+    finally:
+        close_scope(frame)
+
+
+def propagate(func):
+    """Return a wrapper for func that records into the scopes that are open
+    now, for use in another thread. The wrapper opens a scope of its own and
+    merges it into the innermost of those scopes when func returns, so the
+    caller must wait for it before closing that scope."""
+    frames = recorder.get()
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if not frames:
+            return func(*args, **kwargs)
+        token = recorder.set(frames)
+        try:
+            with recording():
+                return func(*args, **kwargs)
+        finally:
+            recorder.reset(token)
+
+    return wrapped
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """A thread pool whose workers record into the scopes that are open when
+    work is submitted."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super(RecordingExecutor, self).submit(
+            propagate(fn), *args, **kwargs
+        )
@@ -0,0 +1,318 @@
+"""The registry keeps track of the cache keys and paths an object or content
+type appears in. It is consulted by the signal handlers to expire cache keys
+and purge paths when objects change.
+
+The default backend stores the registry as lists in Django's caching backend.
+The Redis backend uses native sets so appends are atomic and concurrent
+requests can't drop each other's entries."""
+
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    from django.utils.module_loading import import_string as importer
+except ImportError:
+    from django.utils.module_loading import import_by_path as importer
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# The metadata itself can't be allowed to grow endlessly. This value is the
+# maximum size in bytes of a metadata list. If your caching backend supports
+# compression set a larger value.
+try:
+    MAX_SIZE = settings.ULTRACACHE["max-registry-value-size"]
+except (AttributeError, KeyError):
+    MAX_SIZE = 1000000
+
+
+def member_size(member):
+    """Return the contribution of member to the size of a registry value."""
+    # sys.getsizeof is nearly useless. All our data is stringable so rather
+    # use that as a measure of size. Add two for the separator.
+    return len(repr(member)) + 2
+
+
+def fingerprint(member):
+    """Return a hashable fingerprint for a registry member. Members are cache
+    keys or [path, headers] pairs."""
+    if isinstance(member, str):
+        return member
+    path, headers = member
+    return (path, tuple(sorted(headers.items())))
+
+
+class RegistryList:
+    """A registry value that keeps track of its own size, so appending and
+    evicting the oldest k members cost O(1) and O(k) size updates.
+
+    Registries are stored as plain lists and wrapping one must be cheap too.
+    The size of a list of cache keys is summed from their lengths instead of
+    repr-ing the whole list. The first few membership checks scan the list,
+    and only further checks build an index of fingerprints."""
+
+    # Membership checks that scan the list before an index is built
+    scans = 8
+
+    def __init__(self, members=()):
+        self.members = list(members)
+        if not self.members:
+            self.size = 2
+        elif set(map(type, self.members)) == {str}:
+            # The repr of a cache key is the key in quotes
+            self.size = 2 + sum(map(len, self.members)) \
+                + 4 * len(self.members)
+        else:
+            self.size = len(repr(self.members)) + 2
+        self.index = None
+        self.lookups = 0
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        if self.index is None:
+            self.lookups += 1
+            if self.lookups <= self.scans:
+                return member in self.members
+            self.index = set(map(fingerprint, self.members))
+        return fingerprint(member) in self.index
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def append(self, member):
+        """Append member unless it is already present."""
+        if member not in self:
+            self.members.append(member)
+            self.size += member_size(member)
+            if self.index is not None:
+                self.index.add(fingerprint(member))
+
+    def evict(self, max_size):
+        """Remove the oldest members until the size is less than max_size.
+        Return the removed members."""
+        count = 0
+        size = self.size
+        while (size >= max_size) and (count < len(self.members)):
+            size -= member_size(self.members[count])
+            count += 1
+        evicted = self.members[:count]
+        del self.members[:count]
+        self.size = size
+        if self.index is not None:
+            for member in evicted:
+                self.index.discard(fingerprint(member))
+        return evicted
+
+
+def reduce_list_size(li):
+    """Return two lists
+        - the last N items of li whose total size is less than MAX_SIZE
+        - the rest of the original list li
+    """
+    keep = RegistryList(li)
+    toss = keep.evict(MAX_SIZE)
+    return list(keep), toss
+
+
+def is_path_key(key):
+    """Path registries hold [path, headers] pairs."""
+    return key.startswith("ucache-pth-") or key.startswith("ucache-ct-pth-")
+
+
+def is_fields_key(key):
+    """Field registries hold the names of the fields read from an object. All
+    other registries hold cache keys."""
+    return key.startswith("ucache-fld-")
+
+
+class BaseRegistry:
+    """Registry backends map a registry key to the members recorded against
+    it."""
+
+    def __init__(self, options):
+        self.options = options
+        self.timeout = options.get("timeout", 86400)
+
+    def add_many(self, di):
+        """Append members to registries. di maps a registry key to a list of
+        members."""
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Return a dictionary mapping each existing registry key to a list of
+        members."""
+        raise NotImplementedError
+
+    def pop_many(self, keys):
+        """Like get_many but also remove the registries."""
+        raise NotImplementedError
+
+
+class DjangoCacheRegistry(BaseRegistry):
+    """Store registries as lists in Django's caching backend. While appending
+    a registry is wrapped in a RegistryList so trimming to MAX_SIZE is cheap,
+    but only the plain list is written to the cache. Cache keys that fall off
+    are expired."""
+
+    def add_many(self, di):
+        if not di:
+            return
+
+        current = cache.get_many(list(di.keys()))
+        to_set = {}
+        to_delete = []
+        for key, members in di.items():
+            v = RegistryList(current.get(key, None) or ())
+            changed = False
+            for member in members:
+                if member not in v:
+                    toss = v.evict(MAX_SIZE)
+                    if toss and not (is_path_key(key) or is_fields_key(key)):
+                        to_delete.extend(toss)
+                    v.append(member)
+                    changed = True
+            if changed:
+                # The size and index are rebuilt on read. Storing the index
+                # would roughly double the pickled size.
+                to_set[key] = list(v)
+
+        # Deletion must happen first because set may set some of these keys
+        if to_delete:
+            try:
+                cache.delete_many(to_delete)
+            except NotImplementedError:
+                for k in to_delete:
+                    cache.delete(k)
+
+        if to_set:
+            try:
+                cache.set_many(to_set, self.timeout)
+            except NotImplementedError:
+                for k, v in to_set.items():
+                    cache.set(k, v, self.timeout)
+
+    def get_many(self, keys):
+        return {k: list(v) for k, v in cache.get_many(keys).items()}
+
+    def pop_many(self, keys):
+        di = self.get_many(keys)
+        try:
+            cache.delete_many(keys)
+        except NotImplementedError:
+            for k in keys:
+                cache.delete(k)
+        return di
+
+
+def redis_client(options):
+    """Return a Redis client for the url or client in options."""
+    client = options.get("client", None)
+    if client is not None:
+        # A dotted name to a callable or the callable itself. Mostly useful
+        # for tests.
+        if isinstance(client, str):
+            client = importer(client)
+        return client(options)
+    if redis is None:
+        raise RuntimeError("Library redis not found")
+    return redis.Redis.from_url(options.get("url", "redis://127.0.0.1:6379/0"))
+
+
+class RedisRegistry(BaseRegistry):
+    """Store registries as Redis sets. Appends are done with SADD and
+    invalidation reads and deletes a registry in a single transaction, so no
+    entries are lost under concurrency. MAX_SIZE does not apply."""
+
+    def __init__(self, options):
+        super(RedisRegistry, self).__init__(options)
+        self.prefix = options.get("prefix", "")
+        self.client = redis_client(options)
+
+    def encode(self, key, member):
+        if is_path_key(key):
+            return json.dumps(member)
+        return member
+
+    def decode(self, key, member):
+        if isinstance(member, bytes):
+            member = member.decode("utf-8")
+        if is_path_key(key):
+            return json.loads(member)
+        return member
+
+    def add_many(self, di):
+        if not di:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, members in di.items():
+            if not members:
+                continue
+            pipe.sadd(
+                self.prefix + key, *[self.encode(key, m) for m in members]
+            )
+            pipe.expire(self.prefix + key, self.timeout)
+        pipe.execute()
+
+    def _collect(self, keys, results):
+        di = {}
+        for key, members in zip(keys, results):
+            if members:
+                di[key] = [self.decode(key, m) for m in members]
+        return di
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(self.prefix + key)
+        return self._collect(keys, pipe.execute())
+
+    def pop_many(self, keys):
+        if not keys:
+            return {}
+        pipe = self.client.pipeline(transaction=True)
+        for key in keys:
+            pipe.smembers(self.prefix + key)
+        pipe.delete(*[self.prefix + key for key in keys])
+        return self._collect(keys, pipe.execute()[:-1])
+
+
+def load_registry():
+    try:
+        options = settings.ULTRACACHE["registry"]
+    except (AttributeError, KeyError):
+        options = {}
+    klass = importer(
+        options.get("backend", "ultracache.registry.DjangoCacheRegistry")
+    )
+    return klass(options)
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = load_registry()
+    return _registry
+
+
+@receiver(setting_changed)
+def on_setting_changed(sender, setting, **kwargs):
+    global _registry
+    if setting == "ULTRACACHE":
+        _registry = None
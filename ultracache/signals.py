@@ -1,13 +1,23 @@
 import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.migrations.recorder import MigrationRecorder
 from django.db.models import Model
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
+from ultracache import _thread_locals
+from ultracache.bloom import content_type_item, get_bloom, object_item
+from ultracache.contenttypes import content_type_id
+from ultracache.local import get_local_cache
+from ultracache.recording import ContextVar, ThreadLocalVar, field_names
+from ultracache.registry import fingerprint, get_registry
+from ultracache.utils import mark_stale
+
 try:
     from django.utils.module_loading import import_string as importer
 except ImportError:
@@ -23,6 +33,207 @@ try:
 except (AttributeError, KeyError):
     invalidate = True
 
+try:
+    generations = settings.ULTRACACHE["generations"]
+except (AttributeError, KeyError):
+    generations = False
+
+try:
+    on_commit = settings.ULTRACACHE["invalidate-on-commit"]
+except (AttributeError, KeyError):
+    on_commit = False
+
+try:
+    track_fields = settings.ULTRACACHE["track-fields"]
+except (AttributeError, KeyError):
+    track_fields = False
+
+try:
+    stale = settings.ULTRACACHE["stale"]
+except (AttributeError, KeyError):
+    stale = None
+
+
+def expire_many(pairs):
+    """Expire the cache keys in each registry key and purge the paths in each
+    registry path_key. pairs is a list of (key, path_key) tuples. The
+    registries are removed."""
+    keys = OrderedDict()
+    path_keys = OrderedDict()
+    for key, path_key in pairs:
+        keys[key] = None
+        path_keys[path_key] = None
+
+    if generations:
+        # Bumping the generation orphans all cache entries that recorded the
+        # previous generation. A missing generation already invalidates them.
+        for key in keys:
+            try:
+                cache.incr(key.replace("ucache-", "ucache-gen-", 1))
+            except ValueError:
+                pass
+        di = get_registry().pop_many(list(path_keys))
+    else:
+        di = get_registry().pop_many(list(keys) + list(path_keys))
+
+    # Expire cache keys
+    to_delete = OrderedDict()
+    for key in keys:
+        for k in di.get(key, []):
+            to_delete[k] = None
+    local = get_local_cache()
+    if to_delete and (local is not None):
+        local.expire(list(to_delete))
+
+    if to_delete and stale:
+        # Stale entries are served while they are regenerated
+        mark_stale(list(to_delete))
+    elif to_delete:
+        try:
+            cache.delete_many(list(to_delete))
+        except NotImplementedError:
+            for k in to_delete:
+                cache.delete(k)
+
+    # Purge paths in reverse caching proxy
+    if purger is not None:
+        purged = set()
+        for path_key in path_keys:
+            for li in di.get(path_key, []):
+                fp = fingerprint(li)
+                if fp not in purged:
+                    purged.add(fp)
+                    purger(li[0], li[1])
+
+
+# The batch of the innermost invalidation_batch block. A context variable keeps
+# concurrent coroutines apart.
+current_batch = (ContextVar or ThreadLocalVar)(
+    "ultracache_invalidation_batch", default=None
+)
+
+
+class InvalidationBatch:
+    """Collect the registries to expire and expire them at once when
+    called."""
+
+    def __init__(self):
+        self.pairs = OrderedDict()
+
+    def __call__(self):
+        pairs, self.pairs = self.pairs, OrderedDict()
+        expire_many(pairs.items())
+
+    def add(self, pairs):
+        for key, path_key in pairs:
+            self.pairs[key] = path_key
+
+    def is_pending(self, connection):
+        # Django discards commit hooks of rolled back (savepoint) transactions
+        return any(item[1] is self for item in connection.run_on_commit)
+
+
+def expire(pairs, using=None):
+    """Expire registries now or, if configured, once the current transaction
+    commits. pairs is a list of (key, path_key) tuples."""
+    batch = current_batch.get()
+    if batch is not None:
+        batch.add(pairs)
+        return
+
+    if not on_commit:
+        expire_many(pairs)
+        return
+
+    using = using or DEFAULT_DB_ALIAS
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        expire_many(pairs)
+        return
+
+    # Connections are per thread, and so are the batches waiting on them
+    batches = getattr(_thread_locals, "ultracache_invalidation_batches", None)
+    if batches is None:
+        batches = _thread_locals.ultracache_invalidation_batches = {}
+    batch = batches.get(using, None)
+    if (batch is None) or not batch.is_pending(connection):
+        batch = batches[using] = InvalidationBatch()
+        transaction.on_commit(batch, using=using)
+    batch.add(pairs)
+
+
+@contextmanager
+def invalidation_batch(using=None):
+    """Collect the invalidations made within the block and expire them at once
+    when it exits. Nested blocks are absorbed by the outermost one."""
+    if current_batch.get() is not None:
+        yield current_batch.get()
+        return
+    batch = InvalidationBatch()
+    current_batch.set(batch)
+    try:
+        yield batch
+    finally:
+        current_batch.set(None)
+        if batch.pairs:
+            expire(list(batch.pairs.items()), using=using)
+
+
+def object_keys(ctid, pk):
+    """Return the registry and path registry keys of an object."""
+    return ("ucache-%s-%s" % (ctid, pk), "ucache-pth-%s-%s" % (ctid, pk))
+
+
+def content_type_keys(ctid):
+    """Return the registry and path registry keys of a content type."""
+    return ("ucache-ct-%s" % ctid, "ucache-ct-pth-%s" % ctid)
+
+
+def filter_by_fields(model, ctid, pks, fields):
+    """Return the primary keys in pks of objects from which at least one of
+    fields was read by a cached piece of code. An object without recorded
+    fields is always returned."""
+    if (not track_fields) or (fields is None):
+        return pks
+    names = field_names(model)
+    fields = set([names.get(f, f) for f in fields])
+    keys = ["ucache-fld-%s-%s" % (ctid, pk) for pk in pks]
+    di = get_registry().get_many(keys)
+    return [
+        pk for pk, key in zip(pks, keys)
+        if (key not in di) or fields.intersection(di[key])
+    ]
+
+
+def expire_objects(model, pks, using=None, fields=None):
+    """Expire cache keys affected by the objects of model with primary keys in
+    pks. Used for bulk operations that don't send signals. If fields is given
+    then objects from which none of fields were read are skipped."""
+    if not invalidate:
+        return
+    ctid = content_type_id(model)
+    bloom = get_bloom()
+    if bloom is not None:
+        pks = [
+            pk for pk in pks if bloom.might_contain(object_item(ctid, pk))
+        ]
+    pks = filter_by_fields(model, ctid, pks, fields)
+    if pks:
+        expire([object_keys(ctid, pk) for pk in pks], using=using)
+
+
+def expire_content_type(model, using=None):
+    """Expire cache keys affected by the creation of objects of model. Used
+    for bulk operations that don't send signals."""
+    if not invalidate:
+        return
+    ctid = content_type_id(model)
+    bloom = get_bloom()
+    if (bloom is not None) and not bloom.might_contain(
+            content_type_item(ctid)):
+        return
+    expire([content_type_keys(ctid)], using=using)
+
 
 @receiver(post_save)
 def on_post_save(sender, **kwargs):
@@ -37,52 +248,41 @@ def on_post_save(sender, **kwargs):
     if issubclass(sender, Model):
         obj = kwargs["instance"]
         if isinstance(obj, Model):
-            # get_for_model itself is cached
             try:
-                ct = ContentType.objects.get_for_model(sender)
+                ctid = content_type_id(sender)
             except RuntimeError:
                 # This happens when ultracache is being used by another product
                 # during a test run.
                 return
 
-            if kwargs.get("created", False):
+            created = kwargs.get("created", False)
+            bloom = get_bloom()
+            if bloom is not None:
+                # Objects that were never recorded have no registries
+                if created:
+                    item = content_type_item(ctid)
+                else:
+                    item = object_item(ctid, obj.pk)
+                if not bloom.might_contain(item):
+                    return
+
+            if created:
                 # Expire cache keys that contain objects of this content type
-                key = "ucache-ct-%s" % ct.id
-                to_delete = cache.get(key, [])
-                if to_delete:
-                    try:
-                        cache.delete_many(to_delete)
-                    except NotImplementedError:
-                        for k in to_delete:
-                            cache.delete(k)
-                cache.delete(key)
-
-                # Purge paths in reverse caching proxy that contain objects of
-                # this content type.
-                key = "ucache-ct-pth-%s" % ct.id
-                if purger is not None:
-                    for li in cache.get(key, []):
-                        purger(li[0], li[1])
-                cache.delete(key)
+                # and purge paths in reverse caching proxy that contain
+                # objects of this content type.
+                expire(
+                    [content_type_keys(ctid)], using=kwargs.get("using", None)
+                )
 
             else:
-                # Expire cache keys
-                key = "ucache-%s-%s" % (ct.id, obj.pk)
-                to_delete = cache.get(key, [])
-                if to_delete:
-                    try:
-                        cache.delete_many(to_delete)
-                    except NotImplementedError:
-                        for k in to_delete:
-                            cache.delete(k)
-                cache.delete(key)
-
-                # Purge paths in reverse caching proxy
-                key = "ucache-pth-%s-%s" % (ct.id, obj.pk)
-                if purger is not None:
-                    for li in cache.get(key, []):
-                        purger(li[0], li[1])
-                cache.delete(key)
+                # Skip objects if only fields that were never read changed
+                if filter_by_fields(
+                    sender, ctid, [obj.pk], kwargs.get("update_fields", None)
+                ):
+                    expire(
+                        [object_keys(ctid, obj.pk)],
+                        using=kwargs.get("using", None)
+                    )
 
 
 @receiver(post_delete)
@@ -98,28 +298,18 @@ def on_post_delete(sender, **kwargs):
     if issubclass(sender, Model):
         obj = kwargs["instance"]
         if isinstance(obj, Model):
-            # get_for_model itself is cached
             try:
-                ct = ContentType.objects.get_for_model(sender)
+                ctid = content_type_id(sender)
             except RuntimeError:
                 # This happens when ultracache is being used by another product
                 # during a test run.
                 return
 
-            # Expire cache keys
-            key = "ucache-%s-%s" % (ct.id, obj.pk)
-            to_delete = cache.get(key, [])
-            if to_delete:
-                try:
-                    cache.delete_many(to_delete)
-                except NotImplementedError:
-                    for k in to_delete:
-                        cache.delete(k)
-            cache.delete(key)
-
-            # Invalidate paths in reverse caching proxy
-            key = "ucache-pth-%s-%s" % (ct.id, obj.pk)
-            if purger is not None:
-                for li in cache.get(key, []):
-                    purger(li[0], li[1])
-            cache.delete(key)
+            bloom = get_bloom()
+            if (bloom is not None) and not bloom.might_contain(
+                    object_item(ctid, obj.pk)):
+                return
+
+            expire(
+                [object_keys(ctid, obj.pk)], using=kwargs.get("using", None)
+            )
@@ -1,15 +1,23 @@
+import time
+from collections import OrderedDict
+from copy import copy
+
 from django import template
 from django.utils.encoding import force_text
 from django.utils.translation import ugettext as _
 from django.utils.functional import Promise
 from django.templatetags.cache import CacheNode
 from django.template.base import VariableDoesNotExist
-from django.core.cache import cache
+from django.template.defaulttags import AutoEscapeControlNode, FilterNode, \
+    ForNode, SpacelessNode
 from django.core.cache.utils import make_template_fragment_key
 from django.conf import settings
+from django.db.models.query import QuerySet
 
-from ultracache import _thread_locals
-from ultracache.utils import cache_meta, get_current_site_pk
+from ultracache.recording import in_scope, record_many, recording
+from ultracache.utils import cache_lookup, cache_meta, cache_set, \
+    entry_objects, get_current_site_pk, prefetch, prefetched_entries, \
+    regenerate_in_thread, release_lock, stale_in_background
 
 
 register = template.Library()
@@ -20,13 +28,30 @@ class UltraCacheNode(CacheNode):
     vary on parameter is sites product is installed. Allow unresolvable
     variables. Allow translated strings."""
 
-    def __init__(self, *args):
+    def __init__(self, *args, lock=None):
         # Django 1.7 introduced cache_name. Using different caches makes
         # invalidation difficult. It will be supported in a future version.
         try:
             super(UltraCacheNode, self).__init__(*args, cache_name=None)
         except TypeError:
             super(UltraCacheNode, self).__init__(*args)
+        self.lock = lock
+
+    def get_cache_key(self, context, request):
+        vary_on = []
+        if "django.contrib.sites" in settings.INSTALLED_APPS:
+            vary_on.append(str(get_current_site_pk(request)))
+
+        for var in self.vary_on:
+            try:
+                r = var.resolve(context)
+            except VariableDoesNotExist:
+                pass
+            if isinstance(r, Promise):
+                r = force_text(r)
+            vary_on.append(r)
+
+        return make_template_fragment_key(self.fragment_name, vary_on)
 
     def render(self, context):
         try:
@@ -48,41 +73,135 @@ class UltraCacheNode(CacheNode):
         if request.method.lower() not in ("get", "head"):
             return self.nodelist.render(context)
 
-        # Set a list on the request. Django's template rendering is recursive
-        # and single threaded so we can use a list to keep track of contained
-        # objects.
-        if not hasattr(_thread_locals, "ultracache_recorder"):
-            setattr(_thread_locals, "ultracache_recorder", [])
-            start_index = 0
+        cache_key = self.get_cache_key(context, request)
+
+        def render(context):
+            started = time.time()
+            # Contained tags record into their own frames, which are merged
+            # into this one when they finish.
+            with recording() as frame:
+                value = self.nodelist.render(context)
+            objects = cache_meta(frame, cache_key, request=request)
+            cache_set(
+                cache_key, value, expire_time, objects,
+                delta=time.time() - started
+            )
+            return value
+
+        lock = (self.lock is not None) and self.lock.resolve(context)
+        entry, token, regenerate = cache_lookup(cache_key, lock=lock)
+        if regenerate:
+            if stale_in_background():
+                # Render a copy of the context because this thread continues
+                # to render the original.
+                context_copy = copy(context)
+                regenerate_in_thread(lambda: render(context_copy))
+            else:
+                entry = None
+        if entry is None:
+            try:
+                value = render(context)
+            finally:
+                if token is not None:
+                    release_lock(cache_key, token)
         else:
-            start_index = len(_thread_locals.ultracache_recorder)
+            # A cached result was found. Record the objects manually so outer
+            # template tags are aware of contained objects.
+            value = entry.value
+            if in_scope():
+                record_many(entry_objects(cache_key, entry))
 
-        vary_on = []
-        if "django.contrib.sites" in settings.INSTALLED_APPS:
-            vary_on.append(str(get_current_site_pk(request)))
+        return value
 
-        for var in self.vary_on:
-            try:
-                r = var.resolve(context)
-            except VariableDoesNotExist:
-                pass
-            if isinstance(r, Promise):
-                r = force_text(r)
-            vary_on.append(r)
 
-        cache_key = make_template_fragment_key(self.fragment_name, vary_on)
-        value = cache.get(cache_key)
-        if value is None:
-            value = self.nodelist.render(context)
-            cache.set(cache_key, value, expire_time)
-            cache_meta(_thread_locals.ultracache_recorder, cache_key, start_index, request=request)
-        else:
-            # A cached result was found. Set tuples in _ultracache manually so
-            # outer template tags are aware of contained objects.
-            for tu in cache.get(cache_key + "-objs", []):
-                _thread_locals.ultracache_recorder.append(tu)
+# Tags that always render their contents in the context they are given
+TRANSPARENT_NODES = (AutoEscapeControlNode, FilterNode, SpacelessNode)
+
+
+def evaluated(values):
+    """Return values if iterating over them costs no queries, else None."""
+    if isinstance(values, (list, tuple)):
+        return values
+    if isinstance(values, QuerySet) and (values._result_cache is not None):
+        return values._result_cache
+    return None
+
+
+class PrefetchNode(template.Node):
+    """Fetch the cache entries of ultracache tags in the nodelist in one round
+    trip before rendering it. Tags in for loops over lists and evaluated
+    querysets are included. Tags that may not be rendered, eg. in an if tag,
+    are left alone since finding out would mean doing the work twice."""
+
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def collect(self, nodelist, context, request, keys):
+        for node in nodelist:
+            if isinstance(node, UltraCacheNode):
+                keys[node.get_cache_key(context, request)] = None
+
+            elif isinstance(node, ForNode):
+                values = evaluated(
+                    node.sequence.resolve(context, ignore_failures=True)
+                )
+                if values is None:
+                    continue
+                if node.is_reversed:
+                    values = reversed(values)
+                with context.push():
+                    loop_dict = context["forloop"] = {
+                        "parentloop": context.get("forloop", {})
+                    }
+                    for i, item in enumerate(values):
+                        loop_dict["counter0"] = i
+                        loop_dict["counter"] = i + 1
+                        loop_dict["first"] = (i == 0)
+                        if len(node.loopvars) > 1:
+                            try:
+                                context.update(dict(zip(node.loopvars, item)))
+                            except TypeError:
+                                continue
+                            self.collect(
+                                node.nodelist_loop, context, request, keys
+                            )
+                            context.pop()
+                        else:
+                            context[node.loopvars[0]] = item
+                            self.collect(
+                                node.nodelist_loop, context, request, keys
+                            )
+
+            elif isinstance(node, TRANSPARENT_NODES):
+                for attr in node.child_nodelists:
+                    child = getattr(node, attr, None)
+                    if child:
+                        self.collect(child, context, request, keys)
 
-        return value
+    def render(self, context):
+        request = context.get("request", None)
+        if (request is None) \
+                or (request.method.lower() not in ("get", "head")):
+            return self.nodelist.render(context)
+
+        keys = OrderedDict()
+        self.collect(self.nodelist, context, request, keys)
+        previous = prefetched_entries.get()
+        prefetched = dict(previous or {})
+        prefetched.update(prefetch(list(keys)))
+        prefetched_entries.set(prefetched)
+        try:
+            return self.nodelist.render(context)
+        finally:
+            prefetched_entries.set(previous)
+
+
+@register.tag("ultracache_prefetch")
+def do_ultracache_prefetch(parser, token):
+    """Prefetch the cache entries of the ultracache tags in the block"""
+    nodelist = parser.parse(("endultracache_prefetch",))
+    parser.delete_first_token()
+    return PrefetchNode(nodelist)
 
 
 @register.tag("ultracache")
@@ -93,7 +212,13 @@ def do_ultracache(parser, token):
     tokens = token.split_contents()
     if len(tokens) < 3:
         raise TemplateSyntaxError(""%r" tag requires at least 2 arguments." % tokens[0])
+    # Like using= for Django's cache tag, lock= must be the last argument
+    lock = None
+    if tokens[-1].startswith("lock="):
+        lock = parser.compile_filter(tokens[-1][len("lock="):])
+        tokens = tokens[:-1]
     return UltraCacheNode(nodelist,
         parser.compile_filter(tokens[1]),
         tokens[2], # fragment_name can"t be a variable.
-        [parser.compile_filter(token) for token in tokens[3:]])
+        [parser.compile_filter(token) for token in tokens[3:]],
+        lock=lock)
@@ -1,5 +1,7 @@
 from django.db import models
 
+from ultracache.querysets import UltracacheManager
+
 
 class DummyModel(models.Model):
     title = models.CharField(max_length=32)
@@ -15,3 +17,10 @@ class DummyForeignModel(models.Model):
 class DummyOtherModel(models.Model):
     title = models.CharField(max_length=32)
     code = models.CharField(max_length=32)
+
+
+class DummyBulkModel(models.Model):
+    title = models.CharField(max_length=32)
+    code = models.CharField(max_length=32)
+
+    objects = UltracacheManager()
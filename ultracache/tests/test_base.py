@@ -1,19 +1,24 @@
 ## -*- coding: utf-8 -*-
 
+from unittest import mock
+
 from django import template
 from django.conf import settings
 from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.http.cookie import SimpleCookie
 from django.test import TestCase
 from django.test.client import Client, RequestFactory
 from django.test.utils import override_settings
 from django.urls import reverse
 
-from ultracache import _thread_locals
+from ultracache.registry import DjangoCacheRegistry
+from ultracache.utils import prefetched_entries
 from ultracache.tests.models import DummyModel, DummyForeignModel, \
     DummyOtherModel
 from ultracache.tests import views
-from ultracache.tests.utils import dummy_proxy
+from ultracache.tests.utils import GenerationsMixin, LocalMixin, \
+    StaleMixin, TrackFieldsMixin, dummy_proxy
 
 
 class TemplateTagsTestCase(TestCase):
@@ -292,11 +297,6 @@ class DecoratorTestCase(TestCase):
         super(DecoratorTestCase, self).setUp()
         cache.clear()
         dummy_proxy.clear()
-        # Ultracache is built with the understanding that we have one thread
-        # that exists only during a request. Unit tests don't respect that
-        # because they are long running, so clear thread locals manually.
-        if hasattr(_thread_locals, "ultracache_recorder"):
-            delattr(_thread_locals, "ultracache_recorder")
 
     def test_method(self):
         """Render template through a view with get method decorated with
@@ -556,6 +556,43 @@ class DecoratorTestCase(TestCase):
         self.failUnless('title = Fouxr' in result)
         self.failIf('title = Four' in result)
 
+    def test_buffer_middleware(self):
+        """The registry is written once per request when the buffer middleware
+        is active."""
+        one = DummyModel.objects.create(title='One', code='one')
+        # The view looks the other objects up by code
+        DummyModel.objects.create(title='Two', code='two')
+        DummyForeignModel.objects.create(title='Three', points_to=one, code='three')
+        DummyModel.objects.create(title='Four', code='four')
+        DummyModel.objects.create(title='Five', code='five')
+        url = reverse('method-cached-view')
+
+        with override_settings(
+            MIDDLEWARE=["ultracache.middleware.RegistryBufferMiddleware"]
+        ):
+            with mock.patch(
+                "ultracache.registry.DjangoCacheRegistry.add_many",
+                autospec=True,
+                side_effect=DjangoCacheRegistry.add_many
+            ) as add_many:
+                cache.set("counter", 1)
+                response = self.client.get(url)
+                self.failUnless('counter one = 1' in response.content.decode("utf-8"))
+                self.assertEqual(add_many.call_count, 1)
+
+                # A cache hit writes nothing
+                response = self.client.get(url)
+                self.assertEqual(add_many.call_count, 1)
+
+            cache.set("counter", 2)
+            one.title = 'Onxe'
+            one.save()
+            response = self.client.get(url)
+            result = response.content.decode("utf-8")
+            self.failUnless('title = Onxe' in result)
+            self.failUnless('counter one = 2' in result)
+            self.failUnless('counter two = 1' in result)
+
     def test_header(self):
         """Test that decorator preserves headers
         """
@@ -585,3 +622,128 @@ class DecoratorTestCase(TestCase):
         self.failUnless('aaa=1' in response.content.decode("utf-8"))
         response = self.client.get(url + '?aaa=2')
         self.failIf('aaa=2' in response.content.decode("utf-8"))
+
+
+class GenerationsTemplateTagsTestCase(GenerationsMixin, TemplateTagsTestCase):
+    pass
+
+
+class GenerationsDecoratorTestCase(GenerationsMixin, DecoratorTestCase):
+    pass
+
+
+class TrackFieldsTemplateTagsTestCase(TrackFieldsMixin, TemplateTagsTestCase):
+    pass
+
+
+class TrackFieldsDecoratorTestCase(TrackFieldsMixin, DecoratorTestCase):
+    pass
+
+
+class StaleTemplateTagsTestCase(StaleMixin, TemplateTagsTestCase):
+    pass
+
+
+class StaleDecoratorTestCase(StaleMixin, DecoratorTestCase):
+    pass
+
+
+class LocalTemplateTagsTestCase(LocalMixin, TemplateTagsTestCase):
+    pass
+
+
+class LocalDecoratorTestCase(LocalMixin, DecoratorTestCase):
+    pass
+
+
+class PrefetchTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        cache.clear()
+        self.objs = [
+            DummyModel.objects.create(title="Title %s" % i, code=str(i))
+            for i in range(10)
+        ]
+        self.template = template.Template("{% load ultracache_tags %}\
+            {% ultracache_prefetch %}\
+            {% ultracache 1200 'header' %}header{% endultracache %}\
+            {% for obj in objs %}\
+            {% ultracache 1200 'card' obj.pk %}{{ obj.title }}|{% endultracache %}\
+            {% endfor %}\
+            {% endultracache_prefetch %}"
+        )
+        self.request = RequestFactory().get("/")
+
+    def render(self):
+        return self.template.render(template.Context({
+            "request": self.request, "objs": self.objs
+        })).replace(" ", "")
+
+    def test_prefetch(self):
+        expected = "header" + "".join(
+            "Title%s|" % i for i in range(10)
+        )
+        self.assertEqual(self.render(), expected)
+        with mock.patch.object(
+            LocMemCache, "get", autospec=True, side_effect=LocMemCache.get
+        ) as get, mock.patch.object(
+            LocMemCache, "get_many", autospec=True,
+            side_effect=LocMemCache.get_many
+        ) as get_many:
+            self.assertEqual(self.render(), expected)
+            # LocMemCache.get_many calls get for every key
+            self.assertEqual(get_many.call_count, 1)
+            self.assertEqual(get.call_count, 11)
+
+        # Invalidated cards are rendered again
+        self.objs[3].title = "Changed"
+        self.objs[3].save()
+        self.assertEqual(self.render(), expected.replace("Title3", "Changed"))
+        self.failIf(prefetched_entries.get())
+
+    def test_queries(self):
+        one = self.objs[0]
+        for i in range(3):
+            DummyForeignModel.objects.create(
+                title="Foreign %s" % i, points_to=one, code=str(i)
+            )
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache_prefetch %}\
+            {% for obj in one.dummyforeignmodel_set.all %}\
+            {% ultracache 1200 'foreign' obj.pk %}{{ obj.title }}|{% endultracache %}\
+            {% endfor %}\
+            {% if hidden %}{% for obj in one.dummyforeignmodel_set.all %}\
+            {{ obj.title }}{% endfor %}{% endif %}\
+            {% endultracache_prefetch %}"
+        )
+        context = {"request": self.request, "one": one, "hidden": False}
+        expected = "".join("Foreign%s|" % i for i in range(3))
+        self.assertEqual(
+            t.render(template.Context(context)).replace(" ", ""), expected
+        )
+        # The loop runs its query once even though every fragment hits, and
+        # the hidden loop runs none.
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                t.render(template.Context(context)).replace(" ", ""),
+                expected
+            )
+
+    def test_evaluated_queryset(self):
+        queryset = DummyModel.objects.all()
+        list(queryset)
+        self.render()
+        with mock.patch.object(
+            LocMemCache, "get_many", autospec=True,
+            side_effect=LocMemCache.get_many
+        ) as get_many, self.assertNumQueries(0):
+            self.assertEqual(
+                self.template.render(template.Context({
+                    "request": self.request, "objs": queryset
+                })).replace(" ", ""),
+                "header" + "".join("Title%s|" % i for i in range(10))
+            )
+            self.assertEqual(get_many.call_count, 1)
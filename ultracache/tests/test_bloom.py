@@ -0,0 +1,173 @@
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ultracache.bloom import BloomFilter, SharedBloomFilter, get_bloom, \
+    object_item
+from ultracache.registry import DjangoCacheRegistry
+from ultracache.utils import Ultracache
+from ultracache.tests.models import DummyModel, DummyBulkModel
+
+
+class BloomFilterTestCase(TestCase):
+
+    def test_contains(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add("1-%s" % i)
+        for i in range(1000):
+            self.failUnless("1-%s" % i in bloom)
+        false_positives = len(
+            [i for i in range(1000) if "2-%s" % i in bloom]
+        )
+        self.failUnless(false_positives < 50)
+
+    def test_update(self):
+        one = BloomFilter(capacity=100)
+        one.add("a")
+        two = BloomFilter(capacity=100, bits=one.bits)
+        two.add("b")
+        self.failIf("b" in one)
+        one.update(two)
+        self.failUnless("a" in one)
+        self.failUnless("b" in one)
+
+
+@override_settings(ULTRACACHE={"bloom": {"warmup": 0, "refresh": 0}})
+class BloomSignalsTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(BloomSignalsTestCase, self).setUp()
+        cache.clear()
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.two = DummyModel.objects.create(title="Two", code="two")
+        uc = Ultracache(3600, "one")
+        uc.cache(self.one.title)
+        self.ct = ContentType.objects.get_for_model(DummyModel)
+
+    def pop_many(self):
+        return mock.patch(
+            "ultracache.registry.DjangoCacheRegistry.pop_many",
+            autospec=True,
+            side_effect=DjangoCacheRegistry.pop_many
+        )
+
+    def test_unrecorded(self):
+        with self.pop_many() as pop_many:
+            self.two.save()
+            self.two.delete()
+            DummyBulkModel.objects.create(title="Bulk", code="bulk")
+            self.assertEqual(pop_many.call_count, 0)
+        self.failUnless(Ultracache(3600, "one"))
+
+    def test_recorded(self):
+        with self.pop_many() as pop_many:
+            self.one.save()
+            self.assertEqual(pop_many.call_count, 1)
+        self.failIf(Ultracache(3600, "one"))
+
+    def test_created(self):
+        # A new object of a recorded content type expires the content type
+        DummyModel.objects.create(title="Three", code="three")
+        self.failIf(Ultracache(3600, "one"))
+
+    def test_other_process(self):
+        # Seed the local copy, then let another process record an object
+        bloom = get_bloom()
+        self.failIf(bloom.might_contain(object_item(self.ct.id, self.two.pk)))
+        other = SharedBloomFilter({"warmup": 0})
+        other.add_many([object_item(self.ct.id, self.two.pk)])
+        self.failUnless(
+            bloom.might_contain(object_item(self.ct.id, self.two.pk))
+        )
+        self.failIf(bloom.might_contain(object_item(self.ct.id, 0)))
+
+    def test_confirm_negative(self):
+        # A negative is confirmed even if the copy was refreshed recently
+        bloom = get_bloom()
+        with mock.patch.object(bloom, "refresh", 60):
+            self.failIf(
+                bloom.might_contain(object_item(self.ct.id, self.two.pk))
+            )
+            other = SharedBloomFilter({"warmup": 0})
+            other.add_many([object_item(self.ct.id, self.two.pk)])
+            self.failUnless(
+                bloom.might_contain(object_item(self.ct.id, self.two.pk))
+            )
+
+    def test_publish(self):
+        # Publishing transfers a delta only, without taking the lock. Items
+        # that are present cost nothing.
+        bloom = get_bloom()
+        self.failIf(bloom.might_contain(object_item(self.ct.id, self.two.pk)))
+        with mock.patch.object(bloom, "refresh", 60), \
+                mock.patch("ultracache.bloom.cache", wraps=cache) as cache_:
+            bloom.add_many([object_item(self.ct.id, self.two.pk)])
+            bloom.add_many([object_item(self.ct.id, self.two.pk)])
+        self.assertEqual(
+            [c[0] for c in cache_.method_calls], ["incr", "set"]
+        )
+        self.assertEqual(
+            cache_.method_calls[1][1][1], [object_item(self.ct.id, self.two.pk)]
+        )
+
+    def test_compact(self):
+        bloom = SharedBloomFilter({"warmup": 0, "refresh": 0, "compact": 10})
+        for i in range(25):
+            bloom.add_many(["item-%s" % i])
+        data = cache.get(SharedBloomFilter.key)
+        version = cache.get(SharedBloomFilter.version_key)
+        # The deltas of the last ten versions are left alone
+        self.failUnless(10 <= version - data["version"] < 20)
+        self.failIf(cache.get(SharedBloomFilter.delta_key % data["version"]))
+
+        # A new process loads the stored filter and applies the deltas
+        other = SharedBloomFilter({"warmup": 0})
+        for i in range(25):
+            self.failUnless(other.might_contain("item-%s" % i))
+        self.failIf(other.might_contain("item-x"))
+
+    def test_lost_delta(self):
+        cache.clear()
+        bloom = SharedBloomFilter({"warmup": 0, "refresh": 0, "compact": 10})
+        with mock.patch(
+            "ultracache.bloom.random.getrandbits", side_effect=[0, 1000]
+        ):
+            bloom.add_many(["item-0"])
+            cache.delete(SharedBloomFilter.delta_key % 1)
+            other = SharedBloomFilter({"warmup": 0, "compact": 10})
+            # The delta may still be on its way
+            self.failIf(other.might_contain("item-x"))
+            for i in range(1, 11):
+                bloom.add_many(["item-%s" % i])
+            # Now it is lost so nothing can be ruled out
+            self.failUnless(other.might_contain("item-x"))
+
+            # Compacting starts a new generation, which must warm up again
+            for i in range(11, 21):
+                bloom.add_many(["item-%s" % i])
+        self.assertEqual(cache.get(SharedBloomFilter.key)["version"], 1000)
+        self.failUnless(SharedBloomFilter({}).might_contain("item-x"))
+
+    def test_republish(self):
+        # The shared filter is evicted and recreated by another process. The
+        # local copy must not hide items from it.
+        bloom = get_bloom()
+        item = object_item(self.ct.id, self.one.pk)
+        self.failUnless(bloom.might_contain(item))
+        cache.clear()
+        SharedBloomFilter({"warmup": 0}).add_many([object_item(self.ct.id, 0)])
+        bloom.add_many([item])
+        self.failUnless(SharedBloomFilter({"warmup": 0}).might_contain(item))
+
+    def test_warmup(self):
+        with override_settings(ULTRACACHE={"bloom": {}}):
+            with self.pop_many() as pop_many:
+                self.two.save()
+                self.assertEqual(pop_many.call_count, 1)
@@ -1,15 +1,22 @@
 import copy
 import json
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 from django.urls import reverse
 
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIRequestFactory, APIClient
 
-from ultracache.tests.models import DummyModel
+from ultracache import metrics
+from ultracache.monkey import get_viewset_config
+from ultracache.tests.models import DummyModel, DummyForeignModel
 from ultracache.tests.viewsets import DummyViewSet
 
 
@@ -151,3 +158,130 @@ class DRFTestCase(TestCase):
         response = self.client.get(url)
         as_json_3 = response.json()
         self.assertNotEqual(as_json_1, as_json_3)
+
+    def test_rendered_once(self):
+        with mock.patch.object(
+            JSONRenderer, "render", autospec=True,
+            side_effect=JSONRenderer.render
+        ) as render:
+            response_1 = self.client.get("/api/dummies/")
+            response_2 = self.client.get("/api/dummies/")
+            self.assertEqual(render.call_count, 1)
+        self.assertEqual(response_1.content, response_2.content)
+        self.assertEqual(response_2.status_code, 200)
+        self.assertEqual(response_2["Content-Type"], "application/json")
+
+        # Other media types are cached separately
+        accept = "application/json; indent=4"
+        response_3 = self.client.get("/api/dummies/", HTTP_ACCEPT=accept)
+        self.assertNotEqual(response_1.content, response_3.content)
+        response_4 = self.client.get("/api/dummies/", HTTP_ACCEPT=accept)
+        self.assertEqual(response_3.content, response_4.content)
+        response_5 = self.client.get("/api/dummies/")
+        self.assertEqual(response_1.content, response_5.content)
+
+    def test_local_hit(self):
+        with override_settings(
+            ULTRACACHE=dict(settings.ULTRACACHE, local={})
+        ):
+            metrics.reset()
+            response_1 = self.client.get("/api/dummies/")
+            with mock.patch.object(
+                LocMemCache, "get", autospec=True, side_effect=LocMemCache.get
+            ) as get, mock.patch.object(
+                LocMemCache, "get_many", autospec=True,
+                side_effect=LocMemCache.get_many
+            ) as get_many:
+                response_2 = self.client.get("/api/dummies/")
+                self.assertEqual(get.call_count + get_many.call_count, 0)
+            self.assertEqual(response_1.content, response_2.content)
+            self.assertEqual(metrics.get("local-hits"), 1)
+
+    def test_nested_queries(self):
+        for obj in (self.one, self.two):
+            DummyForeignModel.objects.create(
+                title="Foreign", points_to=obj, code="foreign"
+            )
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/api/nested-dummies/")
+        self.assertEqual(
+            [len(di["dummyforeignmodel_set"]) for di in response.json()],
+            [1, 1]
+        )
+        # Each related manager is evaluated once
+        queries = [
+            q["sql"] for q in context.captured_queries
+            if "tests_dummyforeignmodel" in q["sql"]
+        ]
+        self.assertEqual(len(queries), 2)
+
+        # The objects of nested serializers are recorded
+        DummyForeignModel.objects.filter(points_to=self.one).update(
+            title="Changed"
+        )
+        self.assertEqual(
+            self.client.get("/api/nested-dummies/").json(), response.json()
+        )
+        DummyForeignModel.objects.get(points_to=self.one).save()
+        self.assertNotEqual(
+            self.client.get("/api/nested-dummies/").json(), response.json()
+        )
+
+    def test_viewset_config(self):
+        config = get_viewset_config(DummyViewSet)
+        self.failUnless(get_viewset_config(DummyViewSet) is config)
+        di = copy.deepcopy(settings.ULTRACACHE)
+        di["drf"] = {"viewsets": {object: {}}}
+        with override_settings(ULTRACACHE=di):
+            self.assertEqual(get_viewset_config(DummyViewSet), None)
+        di["drf"] = {
+            "viewsets": {"*": {"evaluate": "request.user.is_anonymous"}}
+        }
+        with override_settings(ULTRACACHE=di):
+            config = get_viewset_config(DummyViewSet)
+            request = self.factory.get("/")
+            request.user = self.user
+            self.assertEqual(
+                config.evaluated(None, request, (), {}), False
+            )
+
+    def test_query_string(self):
+        response = self.client.get("/api/dummies/?b=2&a=1")
+        DummyModel.objects.filter(pk=self.one.pk).update(title="Onae")
+        # The order of the parameters does not matter
+        self.assertEqual(
+            self.client.get("/api/dummies/?a=1&b=2").json(), response.json()
+        )
+        self.assertNotEqual(
+            self.client.get("/api/dummies/?a=1&b=3").json(), response.json()
+        )
+
+        # Parameters that are not allowed are ignored
+        di = copy.deepcopy(settings.ULTRACACHE)
+        di["drf"] = {"viewsets": {"*": {"query-params": ["page"]}}}
+        with override_settings(ULTRACACHE=di):
+            response = self.client.get("/api/dummies/?utm_source=x")
+            DummyModel.objects.filter(pk=self.one.pk).update(title="Onbe")
+            self.assertEqual(
+                self.client.get("/api/dummies/").json(), response.json()
+            )
+
+    def test_pages(self):
+        page_1 = self.client.get("/api/paginated-dummies/?page=1").json()
+        page_2 = self.client.get("/api/paginated-dummies/?page=2").json()
+        self.assertEqual(page_1["results"][0]["title"], "One")
+        self.assertEqual(page_2["results"][0]["title"], "Two")
+
+        # Saving an object only expires the pages that contain it
+        DummyModel.objects.filter(pk=self.two.pk).update(title="Twee")
+        self.one.title = "Een"
+        self.one.save()
+        self.assertEqual(
+            self.client.get(
+                "/api/paginated-dummies/?page=1"
+            ).json()["results"][0]["title"],
+            "Een"
+        )
+        self.assertEqual(
+            self.client.get("/api/paginated-dummies/?page=2").json(), page_2
+        )
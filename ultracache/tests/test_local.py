@@ -0,0 +1,85 @@
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase
+
+from ultracache import metrics
+from ultracache.local import LocalCache
+from ultracache.tests.models import DummyModel
+from ultracache.tests.utils import LocalMixin
+
+
+class LocalCacheTestCase(TestCase):
+
+    def test_lru(self):
+        local = LocalCache({"max-size": 1000})
+        for i in range(10):
+            local.set("key-%s" % i, "x" * 200)
+            # Using a key keeps it in the cache
+            local.get("key-0")
+        self.failUnless(local.size <= 1000)
+        self.assertEqual(local.get("key-0"), "x" * 200)
+        self.assertEqual(local.get("key-9"), "x" * 200)
+        self.assertIsNone(local.get("key-1"))
+
+    def test_timeout(self):
+        local = LocalCache({"timeout": 60})
+        with mock.patch("ultracache.local.time.time", return_value=0):
+            local.set("a", 1)
+            local.set("b", 2, 10)
+        with mock.patch("ultracache.local.time.time", return_value=30):
+            self.assertEqual(local.get("a"), 1)
+            self.assertIsNone(local.get("b"))
+        with mock.patch("ultracache.local.time.time", return_value=61):
+            self.assertIsNone(local.get("a"))
+        self.assertEqual(local.size, 0)
+
+
+class LocalTestCase(LocalMixin, TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(LocalTestCase, self).setUp()
+        cache.clear()
+        metrics.reset()
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.template = Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'outer' %}{% ultracache 1200 'inner' %}\
+            {{ one.title }}{% endultracache %}{% endultracache %}"
+        )
+        self.request = RequestFactory().get("/")
+
+    def render(self):
+        return self.template.render(
+            Context({"request": self.request, "one": self.one})
+        ).strip()
+
+    def test_hit(self):
+        self.assertEqual(self.render(), "One")
+        with mock.patch.object(
+            LocMemCache, "get", autospec=True, side_effect=LocMemCache.get
+        ) as get, mock.patch.object(
+            LocMemCache, "get_many", autospec=True,
+            side_effect=LocMemCache.get_many
+        ) as get_many:
+            self.assertEqual(self.render(), "One")
+            self.assertEqual(get.call_count + get_many.call_count, 0)
+        self.assertEqual(metrics.get("local-hits"), 1)
+
+    def test_invalidation(self):
+        # Another process has the fragments in its local cache
+        other = LocalCache({})
+        self.assertEqual(self.render(), "One")
+        ct = ContentType.objects.get_for_model(DummyModel)
+        for key in cache.get("ucache-%s-%s" % (ct.id, self.one.pk)):
+            other.set(key, "One")
+        self.failUnless(other.size > 0)
+        self.one.title = "Onex"
+        self.one.save()
+        self.assertEqual(other.size, 0)
+        self.assertEqual(self.render(), "Onex")
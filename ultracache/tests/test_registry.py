@@ -0,0 +1,185 @@
+import copy
+import pickle
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from ultracache.registry import DjangoCacheRegistry, RedisRegistry, \
+    RegistryList, get_registry
+from ultracache.utils import Ultracache, cache_meta
+from ultracache.tests.models import DummyModel
+from ultracache.tests.utils import dummy_proxy, fake_redis
+
+
+def redis_settings():
+    di = copy.deepcopy(settings.ULTRACACHE)
+    di["registry"] = {
+        "backend": "ultracache.registry.RedisRegistry",
+        "client": "ultracache.tests.utils.fake_redis_client"
+    }
+    return di
+
+
+class RegistryListTestCase(TestCase):
+
+    def test_size(self):
+        li = RegistryList(["a", ["/a/", {"cookie": ""}]])
+        self.assertEqual(li.size, len(repr(["a", ["/a/", {"cookie": ""}]])) + 2)
+        li.append("b")
+        self.assertEqual(li, ["a", ["/a/", {"cookie": ""}], "b"])
+
+    def test_evict(self):
+        li = RegistryList(["key-%s" % i for i in range(1000)])
+        evicted = li.evict(li.size - 17)
+        self.assertEqual(evicted, ["key-0", "key-1"])
+        self.assertEqual(len(li), 998)
+        self.assertEqual(li.size, len(repr(list(li))) + 2)
+        self.assertEqual(li.evict(li.size + 1), [])
+
+    def test_reduce_list_size(self):
+        # Older code imports these from ultracache.utils
+        from ultracache.utils import MAX_SIZE, reduce_list_size
+        li = ["%100d" % i for i in range(MAX_SIZE // 100)]
+        keep, toss = reduce_list_size(li)
+        self.failUnless(toss)
+        self.assertEqual(len(keep) + len(toss), len(li))
+
+
+class DjangoCacheRegistryTestCase(TestCase):
+
+    def setUp(self):
+        super(DjangoCacheRegistryTestCase, self).setUp()
+        cache.clear()
+        self.registry = DjangoCacheRegistry({})
+
+    def test_add_many(self):
+        self.registry.add_many({"ucache-1-1": ["a", "b"]})
+        self.registry.add_many({"ucache-1-1": ["b", "c"], "ucache-ct-1": ["a"]})
+        self.assertEqual(cache.get("ucache-1-1"), ["a", "b", "c"])
+        self.assertEqual(
+            self.registry.get_many(["ucache-1-1", "ucache-ct-1"]),
+            {"ucache-1-1": ["a", "b", "c"], "ucache-ct-1": ["a"]}
+        )
+
+    def test_pop_many(self):
+        self.registry.add_many({
+            "ucache-1-1": ["a"],
+            "ucache-pth-1-1": [["/a/", {}]]
+        })
+        di = self.registry.pop_many(["ucache-1-1", "ucache-pth-1-1"])
+        self.assertEqual(di["ucache-1-1"], ["a"])
+        self.assertEqual(di["ucache-pth-1-1"], [["/a/", {}]])
+        self.assertEqual(self.registry.get_many(["ucache-1-1"]), {})
+
+    def test_legacy_list(self):
+        cache.set("ucache-1-1", ["a", "b"])
+        self.registry.add_many({"ucache-1-1": ["b", "c"]})
+        self.assertIsInstance(cache.get("ucache-1-1"), list)
+        self.assertEqual(
+            self.registry.get_many(["ucache-1-1"]),
+            {"ucache-1-1": ["a", "b", "c"]}
+        )
+
+    def test_trim(self):
+        cache.set("key-0", 0)
+        cache.set("key-99", 99)
+        with mock.patch("ultracache.registry.MAX_SIZE", 500):
+            self.registry.add_many({
+                "ucache-1-1": ["key-%s" % i for i in range(100)]
+            })
+            self.registry.add_many({"ucache-1-1": ["new"]})
+        li = self.registry.get_many(["ucache-1-1"])["ucache-1-1"]
+        self.assertLess(len(repr(li)), 600)
+        self.assertEqual(li[-1], "new")
+
+        # Cache keys that fall off the registry are expired
+        self.assertIsNone(cache.get("key-0"))
+        self.assertEqual(cache.get("key-99"), 99)
+
+    def test_pickled_size(self):
+        # The stored value must fit in a backend that limits item size, eg.
+        # memcached.
+        with mock.patch("ultracache.registry.MAX_SIZE", 10000):
+            for i in range(3):
+                self.registry.add_many({
+                    "ucache-1-1": ["ucache-%032x" % (i * 1000 + j)
+                                   for j in range(200)]
+                })
+        value = cache.get("ucache-1-1")
+        self.assertIsInstance(value, list)
+        self.assertLessEqual(
+            len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), 10000
+        )
+
+
+class RedisRegistryTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(RedisRegistryTestCase, self).setUp()
+        cache.clear()
+        fake_redis.data.clear()
+        fake_redis.commands = []
+        dummy_proxy.clear()
+
+    def test_backend_setting(self):
+        self.assertIsInstance(get_registry(), DjangoCacheRegistry)
+        with override_settings(ULTRACACHE=redis_settings()):
+            self.assertIsInstance(get_registry(), RedisRegistry)
+        self.assertIsInstance(get_registry(), DjangoCacheRegistry)
+
+    def test_cache_meta(self):
+        request = RequestFactory().get("/aaa/")
+        with override_settings(ULTRACACHE=redis_settings()):
+            cache_meta([(1, 1), (1, 2), (1, 1)], "key-a", request=request)
+            cache_meta([(1, 1)], "key-b", request=request)
+
+            # Each cache_meta call is a single pipeline
+            self.assertEqual(len(fake_redis.commands), 2)
+
+            registry = get_registry()
+            self.assertEqual(
+                sorted(registry.get_many(["ucache-1-1"])["ucache-1-1"]),
+                ["key-a", "key-b"]
+            )
+            self.assertEqual(
+                registry.get_many(["ucache-pth-1-2"])["ucache-pth-1-2"],
+                [["/aaa/", {"cookie": ""}]]
+            )
+
+        # Nothing was written to Django's cache. The object list is stored
+        # along with the value by cache_set.
+        self.assertIsNone(cache.get("ucache-1-1"))
+        self.assertIsNone(cache.get("key-a-objs"))
+
+    def test_invalidation(self):
+        one = DummyModel.objects.create(title="One", code="one")
+        with override_settings(ULTRACACHE=redis_settings()):
+            request = RequestFactory().get("/aaa/")
+            uc = Ultracache(3600, "a", request=request)
+            self.failIf(uc)
+            uc.cache(one.title)
+            dummy_proxy.cache(request, one.title)
+            self.failUnless(Ultracache(3600, "a"))
+            self.failUnless(dummy_proxy.is_cached("/aaa/"))
+
+            one.title = "Onex"
+            one.save()
+            self.failIf(Ultracache(3600, "a"))
+            self.failIf(dummy_proxy.is_cached("/aaa/"))
+
+            # The registries for object one are removed
+            ct = ContentType.objects.get_for_model(DummyModel)
+            self.assertEqual(
+                get_registry().get_many([
+                    "ucache-%s-%s" % (ct.id, one.pk),
+                    "ucache-pth-%s-%s" % (ct.id, one.pk)
+                ]),
+                {}
+            )
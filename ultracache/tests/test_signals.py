@@ -0,0 +1,150 @@
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from ultracache.registry import DjangoCacheRegistry
+from ultracache.utils import Ultracache
+from ultracache.tests.models import DummyModel, DummyBulkModel
+
+
+class OnCommitTestCase(TransactionTestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(OnCommitTestCase, self).setUp()
+        cache.clear()
+        patcher = mock.patch("ultracache.signals.on_commit", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.two = DummyModel.objects.create(title="Two", code="two")
+
+    def cache(self):
+        uc = Ultracache(3600, "one")
+        uc.cache(self.one.title)
+        uc = Ultracache(3600, "two")
+        uc.cache(self.two.title)
+
+    def test_commit(self):
+        self.cache()
+        with mock.patch(
+            "ultracache.registry.DjangoCacheRegistry.pop_many",
+            autospec=True,
+            side_effect=DjangoCacheRegistry.pop_many
+        ) as pop_many:
+            with transaction.atomic():
+                for i in range(10):
+                    self.one.save()
+                    self.two.save()
+                with transaction.atomic():
+                    self.one.save()
+
+                # Nothing is expired until the transaction commits
+                self.failUnless(Ultracache(3600, "one"))
+                self.failUnless(Ultracache(3600, "two"))
+                self.assertEqual(pop_many.call_count, 0)
+
+            self.assertEqual(pop_many.call_count, 1)
+        self.failIf(Ultracache(3600, "one"))
+        self.failIf(Ultracache(3600, "two"))
+
+    def test_rollback(self):
+        self.cache()
+        try:
+            with transaction.atomic():
+                self.one.save()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.failUnless(Ultracache(3600, "one"))
+
+        # A rolled back savepoint only discards its own invalidations
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.one.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            self.two.save()
+        self.failUnless(Ultracache(3600, "one"))
+        self.failIf(Ultracache(3600, "two"))
+
+    def test_autocommit(self):
+        self.cache()
+        self.one.save()
+        self.failIf(Ultracache(3600, "one"))
+        self.failUnless(Ultracache(3600, "two"))
+
+
+class BulkTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(BulkTestCase, self).setUp()
+        cache.clear()
+        self.objs = [
+            DummyBulkModel.objects.create(title="Title %s" % i, code=str(i))
+            for i in range(10)
+        ]
+        self.other = DummyModel.objects.create(title="Other", code="other")
+
+    def cache(self):
+        uc = Ultracache(3600, "first")
+        uc.cache(self.objs[0].title)
+        uc = Ultracache(3600, "last")
+        uc.cache(self.objs[-1].title)
+        uc = Ultracache(3600, "all")
+        uc.cache([obj.title for obj in DummyBulkModel.objects.all()])
+        uc = Ultracache(3600, "other")
+        uc.cache(self.other.title)
+
+    def test_update(self):
+        self.cache()
+        with mock.patch(
+            "ultracache.registry.DjangoCacheRegistry.pop_many",
+            autospec=True,
+            side_effect=DjangoCacheRegistry.pop_many
+        ) as pop_many:
+            DummyBulkModel.objects.filter(code="0").update(code="x")
+            self.assertEqual(pop_many.call_count, 1)
+        self.failIf(Ultracache(3600, "first"))
+        self.failIf(Ultracache(3600, "all"))
+        self.failUnless(Ultracache(3600, "last"))
+        self.failUnless(Ultracache(3600, "other"))
+
+    def test_bulk_create(self):
+        self.cache()
+        DummyBulkModel.objects.bulk_create([
+            DummyBulkModel(title="New", code="new")
+        ])
+        self.failIf(Ultracache(3600, "first"))
+        self.failIf(Ultracache(3600, "all"))
+        self.failUnless(Ultracache(3600, "other"))
+
+    def test_bulk_update(self):
+        self.cache()
+        self.objs[-1].title = "Changed"
+        DummyBulkModel.objects.bulk_update(self.objs[-1:], ["title"])
+        self.failUnless(Ultracache(3600, "first"))
+        self.failIf(Ultracache(3600, "last"))
+        self.failIf(Ultracache(3600, "all"))
+
+    def test_delete(self):
+        self.cache()
+        with mock.patch(
+            "ultracache.registry.DjangoCacheRegistry.pop_many",
+            autospec=True,
+            side_effect=DjangoCacheRegistry.pop_many
+        ) as pop_many:
+            DummyBulkModel.objects.filter(code__in=["0", "9"]).delete()
+            self.assertEqual(pop_many.call_count, 1)
+        self.failIf(Ultracache(3600, "first"))
+        self.failIf(Ultracache(3600, "last"))
+        self.failIf(Ultracache(3600, "all"))
+        self.failUnless(Ultracache(3600, "other"))
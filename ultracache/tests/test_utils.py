@@ -1,10 +1,31 @@
+import asyncio
+import builtins
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipIf
+
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Model
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase
 
-from ultracache import _thread_locals
-from ultracache.utils import Ultracache
-from ultracache.tests.models import DummyModel
+from ultracache import contenttypes, metrics
+from ultracache import registry as ultracache_registry
+from ultracache.decorators import cached_get, compile_param
+from ultracache.recording import MARKER, ContextVar, RecordingExecutor, \
+    close_scope, open_scope, propagate, recorder, recording
+from ultracache.utils import Entry, Ultracache, cache_get, cache_set, \
+    RegistryBuffer, get_current_site_pk, get_entry_or_lock, \
+    regenerate_in_thread, registry_buffer, wait_for_buffers
+from ultracache.tests.models import DummyModel, DummyBulkModel
+from ultracache.tests.utils import GenerationsMixin, StaleMixin, \
+    TrackFieldsMixin
 
 
 class UtilsTestCase(TestCase):
@@ -54,3 +75,743 @@ class UtilsTestCase(TestCase):
 
         uc = Ultracache(3600, "c", "d")
         self.failIf(uc)
+
+    def test_registry_buffer(self):
+        one = DummyModel.objects.create(title="One", code="one")
+        ct = ContentType.objects.get_for_model(DummyModel)
+        key = "ucache-%s-%s" % (ct.id, one.pk)
+
+        with mock.patch(
+            "ultracache.registry.DjangoCacheRegistry.add_many",
+            autospec=True,
+            side_effect=ultracache_registry.DjangoCacheRegistry.add_many
+        ) as add_many:
+            with registry_buffer():
+                uc = Ultracache(3600, "a", "b")
+                uc.cache(one.title)
+                with registry_buffer():
+                    uc = Ultracache(3600, "c", "d")
+                    uc.cache(one.code)
+
+                # Nothing is written until the outermost block exits
+                self.assertIsNone(cache.get(key))
+                self.assertEqual(add_many.call_count, 0)
+
+            self.assertEqual(add_many.call_count, 1)
+            self.assertEqual(len(cache.get(key)), 2)
+
+        one.title = "Onex"
+        one.save()
+        self.failIf(Ultracache(3600, "a", "b"))
+        self.failIf(Ultracache(3600, "c", "d"))
+
+    def test_flush_in_thread(self):
+        threads = []
+
+        def flush(buffer):
+            threads.append(threading.current_thread())
+            raise RuntimeError("Cache is down")
+
+        # All buffers are written by one thread, which survives errors
+        with mock.patch.object(
+            RegistryBuffer, "flush", autospec=True, side_effect=flush
+        ), self.assertLogs("ultracache.utils", "ERROR"):
+            for i in range(10):
+                RegistryBuffer().flush_in_thread()
+            wait_for_buffers()
+        self.assertEqual(len(threads), 10)
+        self.assertEqual(len(set(threads)), 1)
+        self.failIf(threading.current_thread() in threads)
+
+        one = DummyModel.objects.create(title="One", code="one")
+        ct = ContentType.objects.get_for_model(DummyModel)
+        key = "ucache-%s-%s" % (ct.id, one.pk)
+        with registry_buffer() as buffer:
+            Ultracache(3600, "a").cache(one.title)
+            buffer.flush_in_thread()
+            wait_for_buffers()
+            self.assertEqual(len(cache.get(key)), 1)
+
+
+class CachedGetTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(CachedGetTestCase, self).setUp()
+        cache.clear()
+
+    def test_params(self):
+        renders = []
+
+        def color(request, *args, **kwargs):
+            return request.GET.get("color")
+
+        def checked_eval(code, *args):
+            # Strings would be compiled on every request
+            self.failIf(isinstance(code, str))
+            return builtins.eval(code, *args)
+
+        with mock.patch(
+            "ultracache.decorators.compile_param", autospec=True,
+            side_effect=compile_param
+        ) as compile_param_:
+
+            @cached_get(
+                300, color, "kwargs", "request.GET.get('size')",
+                "request.path"
+            )
+            def view(request, **kwargs):
+                renders.append(1)
+                return HttpResponse("content")
+
+            self.assertEqual(compile_param_.call_count, 4)
+            factory = RequestFactory()
+            with mock.patch(
+                "ultracache.decorators.eval", create=True,
+                side_effect=checked_eval
+            ) as eval_:
+                view(factory.get("/", {"color": "red"}))
+                view(factory.get("/", {"color": "red"}))
+                self.failUnless(eval_.call_count > 0)
+            # Parameters are compiled when decorating only
+            self.assertEqual(compile_param_.call_count, 4)
+        self.assertEqual(len(renders), 1)
+        view(factory.get("/", {"color": "blue"}))
+        self.assertEqual(len(renders), 2)
+        view(factory.get("/", {"color": "blue"}), pk=1)
+        self.assertEqual(len(renders), 3)
+        # The query string is only considered through the parameters
+        view(factory.get("/", {"color": "blue", "size": "l"}), pk=1)
+        self.assertEqual(len(renders), 4)
+        view(factory.get("/", {"size": "l", "color": "blue"}), pk=1)
+        self.assertEqual(len(renders), 4)
+
+
+class GenerationsUtilsTestCase(GenerationsMixin, TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(GenerationsUtilsTestCase, self).setUp()
+        cache.clear()
+
+    def test_generations(self):
+        one = DummyModel.objects.create(title="One", code="one")
+        two = DummyModel.objects.create(title="Two", code="two")
+        ct = ContentType.objects.get_for_model(DummyModel)
+
+        uc = Ultracache(3600, "a", "b")
+        uc.cache(one.title)
+        uc = Ultracache(3600, "c", "d")
+        uc.cache(two.title)
+        self.failUnless(Ultracache(3600, "a", "b"))
+        self.failUnless(Ultracache(3600, "c", "d"))
+
+        # No cache keys are registered
+        self.assertIsNone(cache.get("ucache-%s-%s" % (ct.id, one.pk)))
+        self.assertIsNone(cache.get("ucache-ct-%s" % ct.id))
+
+        # Saving one bumps its generation only
+        generation = cache.get("ucache-gen-%s-%s" % (ct.id, one.pk))
+        one.title = "Onex"
+        one.save()
+        self.assertEqual(
+            cache.get("ucache-gen-%s-%s" % (ct.id, one.pk)), generation + 1
+        )
+        self.failIf(Ultracache(3600, "a", "b"))
+        self.failUnless(Ultracache(3600, "c", "d"))
+
+        # An evicted generation invalidates
+        cache.delete("ucache-gen-%s-%s" % (ct.id, two.pk))
+        self.failIf(Ultracache(3600, "c", "d"))
+        uc = Ultracache(3600, "c", "d")
+        uc.cache(two.title)
+        self.failUnless(Ultracache(3600, "c", "d"))
+
+        # Creating an object bumps the content type generation
+        DummyModel.objects.create(title="Three", code="three")
+        self.failIf(Ultracache(3600, "c", "d"))
+
+
+class TrackFieldsUtilsTestCase(TrackFieldsMixin, TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(TrackFieldsUtilsTestCase, self).setUp()
+        cache.clear()
+
+    def test_update_fields(self):
+        one = DummyModel.objects.create(title="One", code="one")
+        ct = ContentType.objects.get_for_model(DummyModel)
+
+        uc = Ultracache(3600, "a")
+        uc.cache(one.title)
+        self.assertEqual(
+            cache.get("ucache-fld-%s-%s" % (ct.id, one.pk)), ["title"]
+        )
+
+        # Only code changed, which was never read
+        one.code = "onex"
+        one.save(update_fields=["code"])
+        self.failUnless(Ultracache(3600, "a"))
+
+        one.title = "Onex"
+        one.save(update_fields=["title"])
+        self.failIf(Ultracache(3600, "a"))
+
+        # Without update_fields any save expires
+        uc = Ultracache(3600, "a")
+        uc.cache(one.title)
+        one.save()
+        self.failIf(Ultracache(3600, "a"))
+
+    def test_fragment_hit(self):
+        one = DummyModel.objects.create(title="One", code="one")
+        ct = ContentType.objects.get_for_model(DummyModel)
+        inner = "{% ultracache 1200 'inner' %}{{ one.title }}{% endultracache %}"
+        request = RequestFactory().get("/")
+
+        def render(s):
+            return Template("{% load ultracache_tags %}" + s).render(
+                Context({"request": request, "one": one})
+            ).strip()
+
+        self.assertEqual(render(inner), "One")
+        # The outer fragment reads code itself and title through the hit
+        cache.delete("ucache-fld-%s-%s" % (ct.id, one.pk))
+        outer = "{% ultracache 1200 'outer' %}{{ one.code }}" + inner \
+            + "{% endultracache %}"
+        self.assertEqual(render(outer), "oneOne")
+        self.assertEqual(
+            cache.get("ucache-fld-%s-%s" % (ct.id, one.pk)), ["code", "title"]
+        )
+
+        one.title = "Onex"
+        one.save(update_fields=["title"])
+        self.assertEqual(render(outer), "oneOnex")
+
+    def test_bulk(self):
+        one = DummyBulkModel.objects.create(title="One", code="one")
+        uc = Ultracache(3600, "a")
+        uc.cache(one.title)
+
+        DummyBulkModel.objects.filter(pk=one.pk).update(code="onex")
+        self.failUnless(Ultracache(3600, "a"))
+
+        DummyBulkModel.objects.filter(pk=one.pk).update(title="Onex")
+        self.failIf(Ultracache(3600, "a"))
+
+
+class LockTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(LockTestCase, self).setUp()
+        cache.clear()
+        metrics.reset()
+
+    def stampede(self, func, threads=20):
+        """Call func from many threads at once and return the results."""
+        barrier = threading.Barrier(threads)
+        results = []
+
+        def target():
+            barrier.wait()
+            results.append(func())
+
+        li = [threading.Thread(target=target) for i in range(threads)]
+        for thread in li:
+            thread.start()
+        for thread in li:
+            thread.join()
+        return results
+
+    def test_ultracache(self):
+        renders = []
+
+        def func():
+            uc = Ultracache(3600, "a", lock=True)
+            if uc:
+                return uc.cached
+            time.sleep(0.2)
+            renders.append(1)
+            uc.cache("value")
+            return "value"
+
+        results = self.stampede(func)
+        self.assertEqual(results, ["value"] * 20)
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(metrics.get("lock-acquired"), 1)
+        self.failUnless(metrics.get("lock-waits") > 0)
+        self.assertEqual(
+            metrics.get("lock-waits"), metrics.get("lock-wait-hits")
+        )
+        self.assertIsNone(cache.get(Ultracache(3600, "a").cache_key + "-lock"))
+
+    def test_decorator(self):
+        renders = []
+        request = RequestFactory().get("/lock/")
+        if "django.contrib.sites" in settings.INSTALLED_APPS:
+            # Warm the sites cache so the threads don't query the database
+            get_current_site_pk(request)
+
+        @cached_get(3600, lock=True)
+        def view(request):
+            time.sleep(0.2)
+            renders.append(1)
+            return HttpResponse("content")
+
+        results = self.stampede(lambda: view(request).content)
+        self.assertEqual(results, [b"content"] * 20)
+        self.assertEqual(len(renders), 1)
+
+    def test_template_tag(self):
+        t = Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'lock' lock=True %}{{ value }}{% endultracache %}"
+        )
+        request = RequestFactory().get("/")
+        result = t.render(Context({"request": request, "value": 1}))
+        self.assertEqual(result.strip(), "1")
+        result = t.render(Context({"request": request, "value": 2}))
+        self.assertEqual(result.strip(), "1")
+        self.assertEqual(metrics.get("lock-acquired"), 1)
+
+    def test_lease(self):
+        # A holder that never releases the lock only delays waiters until the
+        # lease expires.
+        entry, token = get_entry_or_lock("ucache-lease")
+        self.assertIsNotNone(token)
+        with mock.patch("ultracache.utils.LOCK_LEASE", 0.2):
+            entry, token = get_entry_or_lock("ucache-lease")
+        self.assertIsNone(entry)
+        self.assertIsNone(token)
+        self.assertEqual(metrics.get("lock-timeouts"), 1)
+
+
+class StaleUtilsTestCase(StaleMixin, TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(StaleUtilsTestCase, self).setUp()
+        cache.clear()
+        metrics.reset()
+        self.one = DummyModel.objects.create(title="One", code="one")
+
+    def test_inline(self):
+        uc = Ultracache(3600, "a")
+        uc.cache(self.one.title)
+        self.one.title = "Onex"
+        self.one.save()
+
+        # The first reader regenerates while others are served the stale value
+        first = Ultracache(3600, "a")
+        self.failIf(first)
+        second = Ultracache(3600, "a")
+        self.failUnless(second)
+        self.assertEqual(second.cached, "One")
+        first.cache(self.one.title)
+        self.assertEqual(Ultracache(3600, "a").cached, "Onex")
+        self.assertEqual(metrics.get("stale-hits"), 2)
+
+    def test_grace(self):
+        uc = Ultracache(3600, "a")
+        uc.cache(self.one.title)
+        self.one.save()
+        cache.set(uc.cache_key + "-stale", time.time() - 301, None)
+        self.failIf(Ultracache(3600, "a"))
+        self.failIf(Ultracache(3600, "a"))
+
+    def test_expiry(self):
+        uc = Ultracache(3600, "a")
+        uc.cache(self.one.title)
+        self.one.save()
+        with mock.patch("time.time", return_value=time.time() + 301):
+            self.assertIsNone(cache.get(uc.cache_key + "-stale"))
+            self.assertIsNone(cache.get(uc.cache_key))
+            self.failIf(Ultracache(3600, "a"))
+
+    def test_touch(self):
+        uc = Ultracache(3600, "a")
+        uc.cache(self.one.title)
+
+        # The expiry of the entry is changed without writing it again
+        with mock.patch.object(
+            LocMemCache, "touch", autospec=True, side_effect=LocMemCache.touch
+        ) as touch, mock.patch.object(
+            LocMemCache, "set", autospec=True, side_effect=LocMemCache.set
+        ) as set_:
+            self.one.save()
+        touch.assert_any_call(cache, uc.cache_key, 300)
+        keys = [c[0][1] for c in set_.call_args_list]
+        self.failIf(uc.cache_key in keys)
+        self.failIf(Ultracache(3600, "a"))
+        self.assertEqual(Ultracache(3600, "a").cached, "One")
+
+    def test_background(self):
+        threads = []
+        done = threading.Event()
+        t = Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'stale' %}{{ one.title }}{% endultracache %}"
+        )
+        request = RequestFactory().get("/")
+
+        def render():
+            return t.render(
+                Context({"request": request, "one": self.one})
+            ).strip()
+
+        self.assertEqual(render(), "One")
+        self.one.title = "Onex"
+        self.one.save()
+        with mock.patch.dict(self.stale, {"background": True}), \
+                mock.patch(
+                    "ultracache.templatetags.ultracache_tags.regenerate_in_thread",
+                    side_effect=lambda func: threads.append(
+                        regenerate_in_thread(lambda: (done.wait(), func()))
+                    )
+                ):
+            # Every reader gets the stale value until the thread is done
+            self.assertEqual(render(), "One")
+            self.assertEqual(render(), "One")
+            self.assertEqual(len(threads), 1)
+            done.set()
+            threads[0].join()
+            self.assertEqual(render(), "Onex")
+
+        # The regenerated entry is registered again
+        self.one.title = "Onexx"
+        self.one.save()
+        self.assertEqual(render(), "Onexx")
+
+
+class EarlyRecomputeTestCase(TestCase):
+
+    def setUp(self):
+        super(EarlyRecomputeTestCase, self).setUp()
+        cache.clear()
+        metrics.reset()
+        patcher = mock.patch("ultracache.utils.EARLY_RECOMPUTE", 1.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_recompute(self):
+        # A value that took 10 seconds to compute and expires in 5 seconds is
+        # recomputed if -log(1 - random()) >= 0.5, ie. random() >= 0.4.
+        cache_set("ucache-early", "value", 5, [], delta=10)
+        with mock.patch("ultracache.utils.random.random", return_value=0.3):
+            self.assertEqual(cache_get("ucache-early"), "value")
+        with mock.patch("ultracache.utils.random.random", return_value=0.9):
+            self.assertIsNone(cache_get("ucache-early"))
+        self.assertEqual(metrics.get("early-recomputes"), 1)
+
+        # Values without a compute duration expire normally
+        cache_set("ucache-early", "value", 5, [])
+        with mock.patch("ultracache.utils.random.random", return_value=0.9):
+            self.assertEqual(cache_get("ucache-early"), "value")
+
+    def test_ultracache(self):
+        uc = Ultracache(3600, "a")
+        self.failIf(uc)
+        uc.cache("value")
+        self.assertIsInstance(cache.get(uc.cache_key), Entry)
+        self.assertEqual(Ultracache(3600, "a").cached, "value")
+
+    def test_jitter(self):
+        with mock.patch("ultracache.utils.TIMEOUT_JITTER", 0.5), \
+                mock.patch("ultracache.utils.random.random", return_value=1.0):
+            cache_set("ucache-jitter", "value", 100, [], delta=0)
+        entry = cache.get("ucache-jitter")
+        self.failUnless(entry.expiry - time.time() <= 50)
+
+        # Short timeouts are never jittered down to zero, which means don't
+        # cache
+        with mock.patch("ultracache.utils.TIMEOUT_JITTER", 1.0), \
+                mock.patch("ultracache.utils.random.random", return_value=0.9):
+            cache_set("ucache-jitter", "value", 1, [])
+        self.assertEqual(cache_get("ucache-jitter"), "value")
+
+
+class EntryTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(EntryTestCase, self).setUp()
+        cache.clear()
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.template = Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'outer' %}{% ultracache 1200 'inner' %}\
+            {{ one.title }}{% endultracache %}{% endultracache %}"
+        )
+        self.request = RequestFactory().get("/")
+
+    def render(self):
+        return self.template.render(
+            Context({"request": self.request, "one": self.one})
+        ).strip()
+
+    def test_single_round_trip(self):
+        self.render()
+        with mock.patch.object(
+            LocMemCache, "get", autospec=True, side_effect=LocMemCache.get
+        ) as get, mock.patch.object(
+            LocMemCache, "get_many", autospec=True,
+            side_effect=LocMemCache.get_many
+        ) as get_many:
+            with recording() as frame:
+                self.assertEqual(self.render(), "One")
+            self.assertEqual(get.call_count + get_many.call_count, 1)
+
+        # The objects are still replayed to outer scopes
+        ct = ContentType.objects.get_for_model(DummyModel)
+        self.failUnless((ct.id, self.one.pk) in frame)
+
+    def test_old_format(self):
+        # Entries written by earlier versions store the objects separately
+        self.render()
+        ct = ContentType.objects.get_for_model(DummyModel)
+        for key in cache.get("ucache-%s-%s" % (ct.id, self.one.pk)):
+            entry = cache.get(key)
+            cache.set(key, entry.value)
+            cache.set(key + "-objs", entry.objects)
+        with recording() as frame:
+            self.assertEqual(self.render(), "One")
+        self.failUnless((ct.id, self.one.pk) in frame)
+
+
+class RecordingTestCase(TestCase):
+
+    def setUp(self):
+        super(RecordingTestCase, self).setUp()
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.ct = ContentType.objects.get_for_model(DummyModel)
+
+    def test_outside_scope(self):
+        # Attribute access is not patched when no scope is open
+        self.failIf("__getattribute__" in Model.__dict__)
+        self.one.title
+        self.failIf(MARKER in self.one.__dict__)
+
+    def test_once_per_scope(self):
+        with recording() as frame:
+            self.failUnless("__getattribute__" in Model.__dict__)
+            self.one.title
+            self.one.code
+            self.assertEqual(list(frame), [(self.ct.id, self.one.pk)])
+            with recording() as inner:
+                # Nested scopes record the object again
+                self.one.title
+                self.assertEqual(list(inner), [(self.ct.id, self.one.pk)])
+        self.failIf("__getattribute__" in Model.__dict__)
+
+    def test_marker(self):
+        size = len(pickle.dumps(self.one))
+        with recording():
+            self.one.title
+            # The marker refers to the frame by id
+            self.assertIsInstance(self.one.__dict__[MARKER][0], int)
+            self.failUnless(len(pickle.dumps(self.one)) < size + 100)
+
+    def test_nested(self):
+        obj = DummyModel.objects.create(title="Two", code="two")
+        # Reading the content type inside the scopes would record it too
+        one, two = (self.ct.id, self.one.pk), (self.ct.id, obj.pk)
+        with recording() as outer:
+            self.one.title
+            with recording() as inner:
+                obj.title
+                self.one.title
+            self.assertEqual(list(inner), [two, one])
+            # The objects of the inner scope are merged into the outer scope
+            self.assertEqual(list(outer), [one, two])
+        # The recorder is released when the outermost scope closes
+        self.assertEqual(recorder.get(), ())
+
+    def test_out_of_order(self):
+        two = DummyModel.objects.create(title="Two", code="two")
+        outer = open_scope()
+        inner = open_scope()
+        close_scope(outer)
+        two.title
+        close_scope(inner)
+        close_scope(inner)
+        self.assertEqual(list(inner), [(self.ct.id, two.pk)])
+        self.failIf("__getattribute__" in Model.__dict__)
+
+    def test_interleaved(self):
+        # Objects accessed while both scopes are open contribute to both
+        cache.clear()
+        two = DummyModel.objects.create(title="Two", code="two")
+        a = Ultracache(3600, "a")
+        b = Ultracache(3600, "b")
+        a.cache(self.one.title)
+        b.cache(two.title)
+        self.one.save()
+        self.failIf(Ultracache(3600, "a"))
+        b = Ultracache(3600, "b")
+        b.cache(two.title)
+        a = Ultracache(3600, "a")
+        a.cache(self.one.title)
+        two.save()
+        self.failUnless(Ultracache(3600, "a"))
+        self.failIf(Ultracache(3600, "b"))
+
+    def test_executor(self):
+        objs = [
+            DummyModel.objects.create(title=str(i), code=str(i))
+            for i in range(10)
+        ]
+        expected = set([(self.ct.id, obj.pk) for obj in objs])
+        with recording() as frame:
+            with RecordingExecutor(max_workers=4) as executor:
+                titles = list(executor.map(lambda obj: obj.title, objs))
+        self.assertEqual(titles, [str(i) for i in range(10)])
+        self.assertEqual(set(frame), expected)
+
+        # Objects accessed in plain threads are not recorded
+        with recording() as frame:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda obj: obj.title, objs))
+        self.assertEqual(list(frame), [])
+
+    def test_propagate(self):
+        with recording() as frame:
+            thread = threading.Thread(target=propagate(lambda: self.one.title))
+            thread.start()
+            thread.join()
+        self.assertEqual(list(frame), [(self.ct.id, self.one.pk)])
+
+    def test_unsaved(self):
+        with recording() as frame:
+            two = DummyModel(title="Two", code="two")
+            two.title
+            self.assertEqual(list(frame), [(self.ct.id, None)])
+
+
+class ContentTypesTestCase(TestCase):
+
+    def setUp(self):
+        super(ContentTypesTestCase, self).setUp()
+        contenttypes.clear()
+        self.ct = ContentType.objects.get_for_model(DummyModel)
+
+    def test_warm(self):
+        metrics.reset()
+        self.failUnless(contenttypes.warm() > 0)
+        self.assertEqual(
+            contenttypes.content_type_ids[DummyModel], self.ct.id
+        )
+        self.failUnless("content-types-warmup-seconds" in metrics.snapshot())
+
+        # Recording no longer consults the content types framework
+        one = DummyModel.objects.create(title="One", code="one")
+        with mock.patch.object(
+            ContentType.objects, "get_for_model", side_effect=AssertionError
+        ):
+            with recording() as frame:
+                one.title
+        self.assertEqual(list(frame), [(self.ct.id, one.pk)])
+
+    def test_lazy(self):
+        self.failIf(DummyModel in contenttypes.content_type_ids)
+        self.assertEqual(contenttypes.content_type_id(DummyModel), self.ct.id)
+        self.assertEqual(
+            contenttypes.content_type_ids[DummyModel], self.ct.id
+        )
+
+
+def run(coroutine):
+    # asyncio.run needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncTestCase(TestCase):
+    if "django.contrib.sites" in settings.INSTALLED_APPS:
+        fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        cache.clear()
+        self.one = DummyModel.objects.create(title="One", code="one")
+        self.two = DummyModel.objects.create(title="Two", code="two")
+        self.ct = ContentType.objects.get_for_model(DummyModel)
+
+    @skipIf(ContextVar is None, "Coroutines share a thread local recorder")
+    def test_concurrent_scopes(self):
+        async def compute(obj):
+            with recording() as frame:
+                await asyncio.sleep(0)
+                obj.title
+                await asyncio.sleep(0)
+            return frame
+
+        async def main():
+            return await asyncio.gather(compute(self.one), compute(self.two))
+
+        one, two = run(main())
+        self.assertEqual(list(one), [(self.ct.id, self.one.pk)])
+        self.assertEqual(list(two), [(self.ct.id, self.two.pk)])
+
+    @skipIf(ContextVar is None, "Coroutines share a thread local buffer")
+    def test_concurrent_buffers(self):
+        async def compute(obj, key):
+            with registry_buffer() as buffer:
+                uc = Ultracache(3600, key)
+                await asyncio.sleep(0)
+                await uc.acache(obj.title)
+                await asyncio.sleep(0)
+                return list(buffer.registries)
+
+        async def main():
+            return await asyncio.gather(
+                compute(self.one, "a"), compute(self.two, "b")
+            )
+
+        # Executor threads write into the buffer of their coroutine
+        one, two = run(main())
+        key = "ucache-%s-%s"
+        self.failUnless(key % (self.ct.id, self.one.pk) in one)
+        self.failIf(key % (self.ct.id, self.two.pk) in one)
+        self.failUnless(key % (self.ct.id, self.two.pk) in two)
+        self.failIf(key % (self.ct.id, self.one.pk) in two)
+
+    def test_ultracache(self):
+        missing = object()
+
+        async def compute():
+            uc = Ultracache(3600, "a")
+            value = await uc.aget(missing)
+            if value is missing:
+                value = self.one.title
+                await uc.acache(value)
+            return value
+
+        self.assertEqual(run(compute()), "One")
+        self.one.title = "Uno"
+        self.assertEqual(run(compute()), "One")
+        self.one.save()
+        self.assertEqual(run(compute()), "Uno")
+
+    def test_cached_get(self):
+        calls = []
+
+        @cached_get(300)
+        async def view(request):
+            calls.append(1)
+            return HttpResponse(self.one.title)
+
+        request = RequestFactory().get("/aview/")
+        self.assertEqual(run(view(request)).content, b"One")
+        self.assertEqual(run(view(request)).content, b"One")
+        self.assertEqual(len(calls), 1)
+        self.one.save()
+        run(view(request))
+        self.assertEqual(len(calls), 2)
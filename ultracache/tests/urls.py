@@ -7,6 +7,12 @@ from ultracache.tests import views, viewsets
 
 router = DefaultRouter()
 router.register(r"dummies", viewsets.DummyViewSet)
+router.register(
+    r"nested-dummies", viewsets.DummyNestedViewSet, "nested-dummies"
+)
+router.register(
+    r"paginated-dummies", viewsets.DummyPaginatedViewSet, "paginated-dummies"
+)
 
 urlpatterns = [
     url(r"^api/", include(router.urls)),
@@ -1,4 +1,8 @@
 from collections import OrderedDict
+from unittest import mock
+
+from django.conf import settings
+from django.test.utils import override_settings
 
 
 class DummyProxy(dict):
@@ -33,3 +37,116 @@ dummy_proxy = DummyProxy()
 
 def dummy_purger(path, headers=None):
     dummy_proxy.purge(path, headers=headers)
+
+
+class GenerationsMixin:
+    """Run a test case with generation counter invalidation."""
+
+    def setUp(self):
+        super(GenerationsMixin, self).setUp()
+        for name in (
+            "ultracache.utils.GENERATIONS", "ultracache.signals.generations"
+        ):
+            patcher = mock.patch(name, True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TrackFieldsMixin:
+    """Run a test case with field tracking."""
+
+    def setUp(self):
+        super(TrackFieldsMixin, self).setUp()
+        for name in (
+            "ultracache.recording.TRACK_FIELDS",
+            "ultracache.signals.track_fields"
+        ):
+            patcher = mock.patch(name, True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class StaleMixin:
+    """Run a test case with stale entries that the first reader regenerates
+    inline."""
+    stale = {"grace": 300, "background": False}
+
+    def setUp(self):
+        super(StaleMixin, self).setUp()
+        for name in ("ultracache.utils.STALE", "ultracache.signals.stale"):
+            patcher = mock.patch(name, self.stale)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class LocalMixin:
+    """Run a test case with a fresh local cache for every test."""
+
+    def setUp(self):
+        super(LocalMixin, self).setUp()
+        overrider = override_settings(
+            ULTRACACHE=dict(settings.ULTRACACHE, local={})
+        )
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+
+
+class FakeRedis:
+    """In-process stand-in for the subset of the redis client used by
+    RedisRegistry."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def _key(self, key):
+        return key.encode("utf-8") if isinstance(key, str) else key
+
+    def sadd(self, key, *members):
+        s = self.data.setdefault(self._key(key), set())
+        before = len(s)
+        s.update(m.encode("utf-8") if isinstance(m, str) else m for m in members)
+        return len(s) - before
+
+    def smembers(self, key):
+        return set(self.data.get(self._key(key), set()))
+
+    def delete(self, *keys):
+        n = 0
+        for key in keys:
+            if self.data.pop(self._key(key), None) is not None:
+                n += 1
+        return n
+
+    def expire(self, key, timeout):
+        return self._key(key) in self.data
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.queue = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.queue.append((name, args))
+            return self
+        return queue
+
+    def execute(self):
+        # One round trip per pipeline
+        self.client.commands.append([name for name, args in self.queue])
+        result = [getattr(self.client, name)(*args) for name, args in self.queue]
+        self.queue = []
+        return result
+
+
+fake_redis = FakeRedis()
+
+
+def fake_redis_client(options):
+    return fake_redis
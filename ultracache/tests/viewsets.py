@@ -1,8 +1,8 @@
 import django
 
-from rest_framework import viewsets, serializers
+from rest_framework import pagination, viewsets, serializers
 
-from ultracache.tests.models import DummyModel
+from ultracache.tests.models import DummyModel, DummyForeignModel
 
 
 class DummySerializer(serializers.ModelSerializer):
@@ -16,3 +16,33 @@ class DummySerializer(serializers.ModelSerializer):
 class DummyViewSet(viewsets.ModelViewSet):
     queryset = DummyModel.objects.all()
     serializer_class = DummySerializer
+
+
+class DummyForeignSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = DummyForeignModel
+        fields = ("id", "title")
+
+
+class DummyNestedSerializer(serializers.ModelSerializer):
+    dummyforeignmodel_set = DummyForeignSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = DummyModel
+        fields = ("id", "title", "dummyforeignmodel_set")
+
+
+class DummyNestedViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = DummyModel.objects.all()
+    serializer_class = DummyNestedSerializer
+
+
+class DummyPagination(pagination.PageNumberPagination):
+    page_size = 1
+
+
+class DummyPaginatedViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = DummyModel.objects.all().order_by("id")
+    serializer_class = DummySerializer
+    pagination_class = DummyPagination
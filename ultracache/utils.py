@@ -1,20 +1,47 @@
+import asyncio
 import hashlib
+import logging
+import math
+import queue
+import random
+import threading
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
+
+try:
+    from contextvars import copy_context
+except ImportError:
+    copy_context = None
 
 from django.core.cache import cache
 from django.conf import settings
+from django.db import connections
 from django.http.cookie import SimpleCookie
 
-from ultracache import _thread_locals
+from ultracache import metrics
+from ultracache.bloom import content_type_item, get_bloom, object_item
+from ultracache.local import get_local_cache
+from ultracache.recording import ContextVar, ThreadLocalVar, close_scope, \
+    open_scope
+# MAX_SIZE and reduce_list_size are imported from here by older code
+from ultracache.registry import MAX_SIZE, fingerprint, get_registry, \
+    reduce_list_size
 
 
-# The metadata itself can't be allowed to grow endlessly. This value is the
-# maximum size in bytes of a metadata list. If your caching backend supports
-# compression set a larger value.
-try:
-    MAX_SIZE = settings.ULTRACACHE["max-registry-value-size"]
-except (AttributeError, KeyError):
-    MAX_SIZE = 1000000
+logger = logging.getLogger(__name__)
+
+# The active registry buffer and the entries fetched by ultracache_prefetch.
+# Context variables keep concurrent coroutines apart and are copied into the
+# executor by run_async.
+current_buffer = (ContextVar or ThreadLocalVar)(
+    "ultracache_buffer", default=None
+)
+prefetched_entries = (ContextVar or ThreadLocalVar)(
+    "ultracache_prefetched", default=None
+)
 
 try:
     CONSIDER_HEADERS = [
@@ -30,6 +57,55 @@ try:
 except (AttributeError, KeyError):
     CONSIDER_COOKIES = []
 
+# Expire cache entries by bumping per object and per content type generation
+# counters instead of deleting the cache keys in the registry.
+try:
+    GENERATIONS = settings.ULTRACACHE["generations"]
+except (AttributeError, KeyError):
+    GENERATIONS = False
+
+# Regeneration locks expire after lease seconds. Waiters poll for the value
+# every poll seconds.
+try:
+    LOCK_LEASE = settings.ULTRACACHE["lock"]["lease"]
+except (AttributeError, KeyError):
+    LOCK_LEASE = 10
+
+try:
+    LOCK_POLL = settings.ULTRACACHE["lock"]["poll"]
+except (AttributeError, KeyError):
+    LOCK_POLL = 0.05
+
+# Buffers written in the background wait in a queue of at most this many
+# buffers. When it is full buffers are written right away.
+try:
+    BUFFER_QUEUE_SIZE = settings.ULTRACACHE["buffer"]["queue-size"]
+except (AttributeError, KeyError):
+    BUFFER_QUEUE_SIZE = 1000
+
+# Mark invalidated cache entries as stale instead of deleting them. Stale
+# entries are served for at most grace seconds while one reader regenerates
+# them, by default in a background thread.
+try:
+    STALE = settings.ULTRACACHE["stale"]
+except (AttributeError, KeyError):
+    STALE = None
+
+# Recompute cache entries early with a probability that rises as they near
+# expiry. The value is the beta of the XFetch algorithm, where larger values
+# recompute earlier.
+try:
+    EARLY_RECOMPUTE = settings.ULTRACACHE["early-recompute"]
+except (AttributeError, KeyError):
+    EARLY_RECOMPUTE = None
+
+# Shorten timeouts by a random fraction of at most this value so entries that
+# are cached at the same moment don't all expire at the same moment.
+try:
+    TIMEOUT_JITTER = settings.ULTRACACHE["timeout-jitter"]
+except (AttributeError, KeyError):
+    TIMEOUT_JITTER = 0
+
 # Raise on potentially confusing settings
 if CONSIDER_COOKIES and ("cookie" in CONSIDER_HEADERS):
     raise RuntimeError(
@@ -37,30 +113,18 @@ if CONSIDER_COOKIES and ("cookie" in CONSIDER_HEADERS):
 consider-headers"
     )
 
-
-def reduce_list_size(li):
-    """Return two lists
-        - the last N items of li whose total size is less than MAX_SIZE
-        - the rest of the original list li
-    """
-    # sys.getsizeof is nearly useless. All our data is stringable so rather
-    # use that as a measure of size.
-    size = len(repr(li))
-    keep = li
-    toss = []
-    n = len(li)
-    decrement_by = max(n / 10, 10)
-    while (size >= MAX_SIZE) and (n > 0):
-        n -= decrement_by
-        toss = li[:-n]
-        keep = li[-n:]
-        size = len(repr(keep))
-    return keep, toss
+if STALE and GENERATIONS:
+    raise RuntimeError(
+        "stale has a value but generations orphan cache entries instead of \
+marking them stale"
+    )
 
 
 def cache_meta(recorder, cache_key, start_index=0, request=None):
-    """Inspect request for objects in _ultracache and set appropriate entries
-    in Django's cache."""
+    """Register the objects in recorder, typically the frame of a recording
+    scope, as contributing to cache_key and set appropriate entries in Django's
+    cache. Return the list of objects that contribute to cache_key, followed
+    by the (ctid, pk, field) tuples of the fields read from them."""
 
     path = None
     if request is not None:
@@ -83,148 +147,508 @@ def cache_meta(recorder, cache_key, start_index=0, request=None):
                 if k in CONSIDER_HEADERS:
                     headers[k] = v
 
-    # Lists needed for cache.get_many
-    to_set_get_keys = []
-    to_set_paths_get_keys = []
-    to_set_content_types_get_keys = []
-    to_set_content_types_paths_get_keys = []
+    # Ordered sets of registry keys
+    to_set_get_keys = OrderedDict()
+    to_set_paths_get_keys = OrderedDict()
+    to_set_content_types_get_keys = OrderedDict()
+    to_set_content_types_paths_get_keys = OrderedDict()
+
+    to_set_objects = OrderedDict()
+    to_set_fields = OrderedDict()
 
-    # Dictionaries needed for cache.set_many
-    to_set = {}
-    to_set_paths = {}
-    to_set_content_types = {}
-    to_set_content_types_paths = {}
+    if start_index:
+        recorder = list(recorder)[start_index:]
+    for tu in recorder:
+        if len(tu) == 3:
+            # The recorder also holds (ctid, pk, field) when tracking fields
+            to_set_fields.setdefault(tu[:2], OrderedDict())[tu[2]] = None
+            tu = tu[:2]
 
-    to_delete = []
-    to_set_objects = []
+        if tu in to_set_objects:
+            continue
+
+        # A list of objects that contribute to a cache entry
+        to_set_objects[tu] = None
+        ctid, obj_pk = tu
 
-    for ctid, obj_pk in recorder[start_index:]:
         # The object appears in these cache entries. If the object is modified
         # then these cache entries are deleted.
-        key = "ucache-%s-%s" % (ctid, obj_pk)
-        if key not in to_set_get_keys:
-            to_set_get_keys.append(key)
+        to_set_get_keys["ucache-%s-%s" % (ctid, obj_pk)] = None
 
         # The object appears in these paths. If the object is modified then any
         # caches that are read from when browsing to this path are cleared.
-        key = "ucache-pth-%s-%s" % (ctid, obj_pk)
-        if key not in to_set_paths_get_keys:
-            to_set_paths_get_keys.append(key)
+        to_set_paths_get_keys["ucache-pth-%s-%s" % (ctid, obj_pk)] = None
 
         # The content type appears in these cache entries. If an object of this
         # content type is created then these cache entries are cleared.
-        key = "ucache-ct-%s" % ctid
-        if key not in to_set_content_types_get_keys:
-            to_set_content_types_get_keys.append(key)
+        to_set_content_types_get_keys["ucache-ct-%s" % ctid] = None
 
         # The content type appears in these paths. If an object of this content
         # type is created then any caches that are read from when browsing to
         # this path are cleared.
-        key = "ucache-ct-pth-%s" % ctid
-        if key not in to_set_content_types_paths_get_keys:
-            to_set_content_types_paths_get_keys.append(key)
+        to_set_content_types_paths_get_keys["ucache-ct-pth-%s" % ctid] = None
+
+    to_set_objects = list(to_set_objects)
+
+    # Append to all registries in one call to the registry backend. Cache
+    # keys are versioned instead of registered when generations are in use.
+    di = OrderedDict()
+    if not GENERATIONS:
+        for key in chain(to_set_get_keys, to_set_content_types_get_keys):
+            di[key] = [cache_key]
+    if path is not None:
+        for key in chain(
+            to_set_paths_get_keys, to_set_content_types_paths_get_keys
+        ):
+            di[key] = [[path, headers]]
+
+    # The fields read from an object. If an object is saved with update_fields
+    # not in this list then no cache entries are cleared.
+    for (ctid, obj_pk), fields in to_set_fields.items():
+        di["ucache-fld-%s-%s" % (ctid, obj_pk)] = list(fields)
+    objects = {}
+    if to_set_objects:
+        objects[cache_key + "-objs"] = to_set_objects
+
+    # Defer the writes if a buffer is active
+    buffer = current_buffer.get()
+    if buffer is not None:
+        buffer.add(di, objects)
+    else:
+        write_meta(di, objects)
+
+    # Hits replay the fields too, so enclosing entries register them
+    return to_set_objects + [
+        (ctid, obj_pk, field)
+        for (ctid, obj_pk), fields in to_set_fields.items()
+        for field in fields
+    ]
 
-        # A list of objects that contribute to a cache entry
-        tu = (ctid, obj_pk)
-        if tu not in to_set_objects:
-            to_set_objects.append(tu)
-
-    # todo: rewrite to handle absence of get_many
-    di = cache.get_many(to_set_get_keys)
-    for key in to_set_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set[key] = keep
-                to_delete.extend(toss)
-        if cache_key not in keep:
-            if key not in to_set:
-                to_set[key] = keep
-            to_set[key] = to_set[key] + [cache_key]
-    if to_set == di:
-        to_set = {}
-
-    di = cache.get_many(to_set_paths_get_keys)
-    for key in to_set_paths_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_paths[key] = keep
-        if path is not None:
-            if [path, headers] not in keep:
-                if key not in to_set_paths:
-                    to_set_paths[key] = keep
-                to_set_paths[key] = to_set_paths[key] + [[path, headers]]
-    if to_set_paths == di:
-        to_set_paths = {}
-
-    di = cache.get_many(to_set_content_types_get_keys)
-    for key in to_set_content_types_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_content_types[key] = keep
-                to_delete.extend(toss)
-        if cache_key not in keep:
-            if key not in to_set_content_types:
-                to_set_content_types[key] = keep
-            to_set_content_types[key] = to_set_content_types[key] + [cache_key]
-    if to_set_content_types == di:
-        to_set_content_types = {}
-
-    di = cache.get_many(to_set_content_types_paths_get_keys)
-    for key in to_set_content_types_paths_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_content_types_paths[key] = keep
-        if path is not None:
-            if [path, headers] not in keep:
-               if key not in to_set_content_types_paths:
-                    to_set_content_types_paths[key] = keep
-               to_set_content_types_paths[key] = to_set_content_types_paths[key] \
-                    + [[path, headers]]
-    if to_set_content_types_paths == di:
-        to_set_content_types_paths = {}
-
-    # Deletion must happen first because set may set some of these keys
-    if to_delete:
-        try:
-            cache.delete_many(to_delete)
-        except NotImplementedError:
-            for k in to_delete:
-                cache.delete(k)
-
-    # Do one set_many
-    di = {}
-    di.update(to_set)
-    del to_set
-    di.update(to_set_paths)
-    del to_set_paths
-    di.update(to_set_content_types)
-    del to_set_content_types
-    di.update(to_set_content_types_paths)
-    del to_set_content_types_paths
 
-    if to_set_objects:
-        di[cache_key + "-objs"] = to_set_objects
+def write_meta(registries, objects):
+    """Append to registries and set the lists of objects that contribute to
+    cache entries."""
+    # The filter must know about the objects before the registries exist
+    bloom = get_bloom()
+    if bloom is not None:
+        items = OrderedDict()
+        for ctid, obj_pk in chain(*objects.values()):
+            items[object_item(ctid, obj_pk)] = None
+            items[content_type_item(ctid)] = None
+        bloom.add_many(list(items))
+
+    get_registry().add_many(registries)
 
-    if di:
+    # Generations need the lists of objects to validate cache entries.
+    # Otherwise they are stored along with the values.
+    if objects and GENERATIONS:
         try:
-            cache.set_many(di, 86400)
+            cache.set_many(objects, 86400)
         except NotImplementedError:
-            for k, v in di.items():
+            for k, v in objects.items():
                 cache.set(k, v, 86400)
 
 
+class RegistryBuffer:
+    """Accumulate registry appends so they can be written in one go. Appends
+    to the same registry key are merged."""
+
+    def __init__(self):
+        self.registries = OrderedDict()
+        self.objects = {}
+
+    def add(self, registries, objects):
+        for key, members in registries.items():
+            di = self.registries.setdefault(key, OrderedDict())
+            for member in members:
+                di.setdefault(fingerprint(member), member)
+        self.objects.update(objects)
+
+    def flush(self):
+        registries, objects = self.registries, self.objects
+        self.registries = OrderedDict()
+        self.objects = {}
+        if registries or objects:
+            write_meta(
+                OrderedDict(
+                    (k, list(v.values())) for k, v in registries.items()
+                ),
+                objects
+            )
+
+    def flush_in_thread(self):
+        """Queue the buffer for the background writer thread."""
+        start_buffer_writer()
+        try:
+            _buffer_queue.put_nowait(self)
+        except queue.Full:
+            metrics.incr("buffer-queue-full")
+            self.flush()
+
+
+_buffer_queue = queue.Queue(BUFFER_QUEUE_SIZE)
+_buffer_writer = None
+_buffer_writer_lock = threading.Lock()
+
+
+def write_buffers():
+    """Write queued buffers one at a time, forever."""
+    while True:
+        buffer = _buffer_queue.get()
+        try:
+            buffer.flush()
+        except Exception:
+            logger.exception("Could not write a registry buffer")
+        finally:
+            _buffer_queue.task_done()
+
+
+def start_buffer_writer():
+    """Start the thread that writes queued buffers unless it is running. A
+    forked process has to start its own."""
+    global _buffer_writer
+    if (_buffer_writer is not None) and _buffer_writer.is_alive():
+        return
+    with _buffer_writer_lock:
+        if (_buffer_writer is None) or not _buffer_writer.is_alive():
+            _buffer_writer = threading.Thread(target=write_buffers)
+            _buffer_writer.daemon = True
+            _buffer_writer.start()
+
+
+def wait_for_buffers():
+    """Block until all queued buffers are written."""
+    _buffer_queue.join()
+
+
+@contextmanager
+def registry_buffer():
+    """Buffer all registry appends made within the block and write them when
+    the block exits. Nested blocks are absorbed by the outermost one."""
+    if current_buffer.get() is not None:
+        yield current_buffer.get()
+        return
+    buffer = RegistryBuffer()
+    current_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        current_buffer.set(None)
+        buffer.flush()
+
+
+def generation_keys(objects):
+    """Return the generation counter keys for a list of (ctid, pk) tuples.
+    (ctid, pk, field) tuples are skipped."""
+    keys = []
+    for tu in objects:
+        if len(tu) == 3:
+            continue
+        ctid, obj_pk = tu
+        keys.append("ucache-gen-%s-%s" % (ctid, obj_pk))
+        key = "ucache-gen-ct-%s" % ctid
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def versioned_key(cache_key, generations):
+    """Extend cache_key with a digest of the generation counters."""
+    s = ":".join(["%s=%s" % (k, generations[k]) for k in sorted(generations)])
+    return "%s-%s" % (cache_key, hashlib.md5(s.encode("utf-8")).hexdigest())
+
+
+def mark_stale(cache_keys):
+    """Mark cache entries as stale as of now instead of deleting them. The
+    markers and the entries expire after the grace period. An entry that
+    outlived its marker would be served as fresh again."""
+    now = time.time()
+    grace = STALE.get("grace", 300)
+    cache.set_many({k + "-stale": now for k in cache_keys}, grace)
+
+    # Cache.touch is new in Django 2.1. Older versions write the entries
+    # again with the new expiry.
+    touch = getattr(cache, "touch", None)
+    if touch is not None:
+        for k in cache_keys:
+            touch(k, grace)
+    else:
+        cache.set_many(cache.get_many(cache_keys), grace)
+
+
+class Entry:
+    """A cached value along with the (ctid, pk) and (ctid, pk, field) tuples
+    that contribute to it, so a hit needs a single round trip. For early
+    recomputation delta is the number of seconds it took to compute the value
+    and expiry is the time it expires."""
+
+    def __init__(self, value, objects=None, delta=None, expiry=None):
+        self.value = value
+        self.objects = objects
+        self.delta = delta
+        self.expiry = expiry
+
+    def recompute(self, beta):
+        """Return True if the caller should recompute the value now."""
+        if (self.delta is None) or (self.expiry is None):
+            return False
+        # 1 - random() is in (0, 1] so the log is defined
+        now = time.time()
+        return now - self.delta * beta * math.log(1.0 - random.random()) \
+            >= self.expiry
+
+
+def to_entry(value):
+    """Return the Entry for a value in the cache. Values written before
+    entries were introduced are wrapped and have no objects."""
+    if (value is None) or isinstance(value, Entry):
+        return value
+    return Entry(value)
+
+
+def check_early(entry):
+    """Return entry, or None if the caller should recompute it early."""
+    if (entry is not None) and EARLY_RECOMPUTE \
+            and entry.recompute(EARLY_RECOMPUTE):
+        metrics.incr("early-recomputes")
+        return None
+    return entry
+
+
+def get_entry_stale(cache_key):
+    """Get an Entry set by cache_set if stale entries are enabled. Return a
+    tuple (entry, marked) where marked is the time the entry was marked stale
+    or None if it is fresh. Entries past the grace period are not returned."""
+    values = cache.get_many([cache_key, cache_key + "-stale"])
+    entry = to_entry(values.get(cache_key, None))
+    marked = values.get(cache_key + "-stale", None)
+    if marked is None:
+        return check_early(entry), None
+    if time.time() - marked > STALE.get("grace", 300):
+        return None, None
+    return entry, marked
+
+
+def get_entry(cache_key):
+    """Get the Entry set by cache_set or None."""
+    if STALE:
+        return get_entry_stale(cache_key)[0]
+
+    if not GENERATIONS:
+        return check_early(to_entry(cache.get(cache_key)))
+
+    # The generations of the objects recorded for cache_key must all still be
+    # present, else the cache entry can't be validated.
+    keys = generation_keys(cache.get(cache_key + "-objs", []))
+    generations = cache.get_many(keys) if keys else {}
+    if len(generations) != len(keys):
+        return None
+    return check_early(
+        to_entry(cache.get(versioned_key(cache_key, generations)))
+    )
+
+
+def cache_get(cache_key, default=None):
+    """Get a value set by cache_set."""
+    entry = get_entry(cache_key)
+    if entry is None:
+        return default
+    return entry.value
+
+
+def cache_set(cache_key, value, timeout, objects, delta=None):
+    """Set a value in the cache. The objects are the tuples as returned by
+    cache_meta. delta is the number of seconds it took to compute the
+    value."""
+    entry = Entry(value, objects)
+    if timeout:
+        if TIMEOUT_JITTER:
+            # Zero would mean don't cache at all for some backends
+            timeout = max(
+                1, int(timeout * (1 - random.random() * TIMEOUT_JITTER))
+            )
+        if EARLY_RECOMPUTE and (delta is not None):
+            entry.delta = delta
+            entry.expiry = time.time() + timeout
+
+    local = get_local_cache()
+    if local is not None:
+        local.set(cache_key, entry, timeout)
+
+    if STALE:
+        cache.set(cache_key, entry, timeout)
+        cache.delete_many([cache_key + "-stale", cache_key + "-regen"])
+        return
+
+    if not GENERATIONS:
+        cache.set(cache_key, entry, timeout)
+        return
+
+    keys = generation_keys(objects)
+    generations = cache.get_many(keys) if keys else {}
+    missing = [k for k in keys if k not in generations]
+    if missing:
+        # Start at a random value so an evicted generation never reverts to a
+        # value that validates an old cache entry.
+        for k in missing:
+            cache.add(k, random.getrandbits(48), None)
+        generations.update(cache.get_many(missing))
+    cache.set(versioned_key(cache_key, generations), entry, timeout)
+
+
+def get_entry_or_lock(cache_key):
+    """Get an Entry set by cache_set. On a miss only one caller acquires the
+    lock for cache_key and regenerates the value while the others wait for it.
+
+    Return a tuple (entry, token). If token is not None the caller holds the
+    lock and must call release_lock once the value is set. Waiters that time
+    out get (None, None) and regenerate the value themselves."""
+    entry = get_entry(cache_key)
+    if entry is not None:
+        return entry, None
+
+    lock_key = cache_key + "-lock"
+    token = random.getrandbits(48)
+    start = time.time()
+    waited = False
+    while True:
+        if cache.add(lock_key, token, LOCK_LEASE):
+            metrics.incr("lock-acquired")
+            # The previous holder may have set the value in the meantime
+            entry = get_entry(cache_key) if waited else None
+            if entry is not None:
+                release_lock(cache_key, token)
+                return entry, None
+            return None, token
+
+        if not waited:
+            metrics.incr("lock-waits")
+            waited = True
+        if time.time() - start >= LOCK_LEASE:
+            metrics.incr("lock-timeouts")
+            return None, None
+        time.sleep(LOCK_POLL)
+        metrics.incr("lock-wait-seconds", LOCK_POLL)
+
+        entry = get_entry(cache_key)
+        if entry is not None:
+            metrics.incr("lock-wait-hits")
+            return entry, None
+
+
+def release_lock(cache_key, token):
+    """Release a lock acquired by get_entry_or_lock unless its lease has
+    expired and another caller acquired it."""
+    lock_key = cache_key + "-lock"
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def cache_lookup(cache_key, lock=False):
+    """Get an Entry for one of the cache entry points, taking the local cache,
+    regeneration locks and stale entries into account.
+
+    Return a tuple (entry, token, regenerate). The entry is None on a miss and
+    the token is as returned by get_entry_or_lock. If regenerate is True the
+    entry is stale and the caller is the one reader that must regenerate
+    it."""
+    local = get_local_cache()
+    if local is not None:
+        entry = local.get(cache_key, None)
+        if entry is not None:
+            metrics.incr("local-hits")
+            return entry, None, False
+
+    prefetched = prefetched_entries.get()
+    if prefetched:
+        entry = check_early(prefetched.get(cache_key, None))
+        if entry is not None:
+            metrics.incr("prefetch-hits")
+            if local is not None:
+                local.set(cache_key, entry)
+            return entry, None, False
+
+    token = None
+    if STALE:
+        entry, marked = get_entry_stale(cache_key)
+        if (entry is not None) and (marked is not None):
+            metrics.incr("stale-hits")
+            regenerate = cache.add(cache_key + "-regen", 1, LOCK_LEASE)
+            return entry, None, regenerate
+        if (entry is None) and lock:
+            entry, token = get_entry_or_lock(cache_key)
+    elif lock:
+        entry, token = get_entry_or_lock(cache_key)
+    else:
+        entry = get_entry(cache_key)
+
+    if (local is not None) and (entry is not None):
+        local.set(cache_key, entry)
+    return entry, token, False
+
+
+def prefetch(cache_keys):
+    """Fetch the entries for cache_keys in one round trip. Return a dictionary
+    of cache key to Entry for the keys that were found. Stale entries and
+    generations need more than one round trip so nothing is prefetched."""
+    if STALE or GENERATIONS:
+        return {}
+    local = get_local_cache()
+    if local is not None:
+        cache_keys = [k for k in cache_keys if local.get(k, None) is None]
+    if not cache_keys:
+        return {}
+    return {
+        k: to_entry(v) for k, v in cache.get_many(cache_keys).items()
+    }
+
+
+def entry_objects(cache_key, entry):
+    """Return the tuples recorded for an entry. Entries written before
+    objects were stored along with the value need a lookup and have no
+    fields."""
+    if entry.objects is not None:
+        return entry.objects
+    return cache.get(cache_key + "-objs", [])
+
+
+def stale_in_background():
+    return STALE.get("background", True)
+
+
+def regenerate_in_thread(func):
+    """Call func in a new thread, which starts with an empty recorder."""
+
+    def target():
+        try:
+            func()
+        finally:
+            connections.close_all()
+
+    metrics.incr("stale-regenerations")
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def regenerate_in_task(func):
+    """Schedule the coroutine function func on the running event loop."""
+    metrics.incr("stale-regenerations")
+    return asyncio.ensure_future(func())
+
+
+async def run_async(func, *args):
+    """Call the blocking func in the default executor so the event loop is not
+    blocked, which is also what Django's async cache methods do. One call can
+    cover several round trips, eg. cache_lookup. The current context, and so
+    the recorder, is copied into the executor thread."""
+    loop = asyncio.get_event_loop()
+    if copy_context is not None:
+        func = partial(copy_context().run, func)
+    return await loop.run_in_executor(None, partial(func, *args))
+
+
 def get_current_site_pk(request):
     """Seemingly pointless function is so calling code doesn't have to worry
     about the import issues between Django 1.6 and later."""
@@ -243,38 +667,86 @@ empty_marker_2 = EmptyMarker()
 
 
 class Ultracache:
-    """Cache arbitrary pieces of Python code.
+    """Cache arbitrary pieces of Python code. With lock=True only one caller
+    regenerates a missing value and others wait for it. Coroutines use aget
+    and acache instead of cached and cache.
     """
 
-    def __init__(self, timeout, name, *params, request=None):
+    def __init__(self, timeout, name, *params, request=None, lock=False):
         self.timeout = timeout
         self.request = request
+        self.lock = lock
+        self.token = None
         self._cached = empty_marker_1
         s = ":".join([name] + [str(p) for p in params])
         hashed = hashlib.md5(s.encode("utf-8")).hexdigest()
         self.cache_key = "ucache-%s" % hashed
-        self.start_index = len(_thread_locals.ultracache_recorder) 
+        self.frame = open_scope()
         self.used = False
+        self.started = time.time()
+
+    def __del__(self):
+        # The value may never have been looked up or cached
+        self.close_scope()
 
     @property
     def cached(self):
         if self._cached is empty_marker_1:
-            self._cached = cache.get(self.cache_key, empty_marker_2)
+            self.looked_up(*cache_lookup(self.cache_key, lock=self.lock))
+        return self._cached
+
+    async def aget(self, default=None):
+        """Async variant of cached. Return the cached value or default."""
+        if self._cached is empty_marker_1:
+            self.looked_up(
+                *await run_async(cache_lookup, self.cache_key, self.lock)
+            )
+        if self._cached is empty_marker_2:
+            return default
         return self._cached
 
+    def looked_up(self, entry, token, regenerate):
+        self.token = token
+        if (entry is None) or regenerate:
+            # The caller computes the value itself, so this reader
+            # regenerates a stale entry inline.
+            self._cached = empty_marker_2
+        else:
+            self._cached = entry.value
+            self.close_scope()
+
+    def close_scope(self):
+        close_scope(self.frame)
+
     def __bool__(self):
         return self.cached is not empty_marker_2
 
     def cache(self, value):
+        self.use()
+        self.write(value)
+
+    async def acache(self, value):
+        """Async variant of cache."""
+        self.use()
+        await run_async(self.write, value)
+
+    def use(self):
         if self.used:
             raise RuntimeError(
                 "The cache method may only be called once per Ultracache object."
             )
-        cache.set(self.cache_key, value, self.timeout)
-        cache_meta(
-            _thread_locals.ultracache_recorder,
-            self.cache_key,
-            start_index=self.start_index,
-            request=self.request
-        )
         self.used = True
+        # The scope must be closed in the context it was opened in
+        self.close_scope()
+
+    def write(self, value):
+        objects = cache_meta(self.frame, self.cache_key, request=self.request)
+        try:
+            cache_set(
+                self.cache_key, value, self.timeout, objects,
+                delta=time.time() - self.started
+            )
+        finally:
+            if self.token is not None:
+                release_lock(self.cache_key, self.token)
+                self.token = None